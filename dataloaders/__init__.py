@@ -1,2 +1,2 @@
 from .challenge_loader import ChallengeDataset
-from .ams_voxel_loader import AmsVoxelLoader
\ No newline at end of file
+from .ams_voxel_loader import AmsVoxelLoader, collate_voxel_batch
\ No newline at end of file
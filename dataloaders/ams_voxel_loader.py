@@ -6,10 +6,13 @@ import numpy as np
 import pykeops
 import pickle
 from .dataset_utils import registration_pipeline, context_voxel_center
+from .cloud_store import CloudStore, open_store
 from utils import (load_las,
                    co_unit_sphere,
                    extract_area,
-                   rotate_xy,get_voxel,get_all_voxel_centers,get_voxel_center)
+                   rotate_xy,get_voxel,VoxelGrid,
+                   batched_co_unit_sphere,batched_fps,batched_rotate_xy)
+from torch.nn.utils.rnn import pad_sequence
 
 from itertools import combinations, combinations_with_replacement,product
 from torch_cluster import fps
@@ -18,27 +21,191 @@ from torch.utils.data import Dataset
 import json
 from datetime import datetime
 import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
 import open3d as o3d
-import torch_cluster
-from utils import voxelize
+from scipy.spatial import cKDTree
 eps = 1e-8
 
 
 
 
 
+class ScanIndex:
+    """KD-tree over Scan.center for bulk radius queries"""
+    def __init__(self, scans_list):
+        self.scans_list = scans_list
+        self.centers = np.stack([x.center for x in scans_list]) if len(scans_list) > 0 else np.zeros((0, 2))
+        self.tree = cKDTree(self.centers)
+
+    def radius(self, centers, dist):
+        """Indices of scans strictly closer than dist to each of centers"""
+        # query_ball_point includes the boundary, previous filtering used strict <
+        return self.tree.query_ball_point(np.atleast_2d(centers), r=np.nextafter(dist, 0))
+
+    def relevant_scans(self, scans, dist):
+        """For each of scans the list of indexed scans within dist of it"""
+        if len(scans) == 0:
+            return []
+        return [[self.scans_list[ind] for ind in sorted(neighbours)] for neighbours in self.radius([x.center for x in scans], dist)]
+
+    def thin(self, dist):
+        """Greedy thinning in list order, keeps a scan unless an earlier kept scan is within dist"""
+        ignore = np.zeros(len(self.scans_list), dtype=bool)
+        keep = []
+        for index, neighbours in enumerate(tqdm(self.radius(self.centers, dist))):
+            if ignore[index]:
+                continue
+            keep.append(index)
+            ignore[neighbours] = True
+        return keep
+
+
 def filter_scans(scans_list, dist):
     print(f"Filtering scans")
-    ignore_list = []
-    keep_scans = []
-    for scan in tqdm(scans_list):
-        if scan in ignore_list:
-            continue
-        else:
-            keep_scans.append(scan)
-        ignore_list.extend(
-            [x for x in scans_list if np.linalg.norm(x.center-scan.center) < dist])
-    return keep_scans
+    index = ScanIndex(scans_list)
+    return [scans_list[x] for x in index.thin(dist)]
+
+
+def process_scene(scene_number, scan, relevant_scans, store_path, clearance, max_height,
+                  voxel_size_icp, voxel_size_final_downsample, cell_size=None, registration_cache=None, device='cpu',
+                  registration_backend='open3d', build=None):
+    """Load, crop, register and height filter clouds around scan center, writes them as one shard of the store at store_path"""
+    # Sorted so the registration target (and its cached transforms) is the same between rebuilds
+    relevant_times = sorted(set([x.datetime for x in relevant_scans]))
+
+    # Group by dates
+    time_partitions = {time: [
+        x for x in relevant_scans if x.datetime == time] for time in relevant_times}
+
+    # Load and combine clouds from same date, streaming only the square at center since only those will be used for grid
+    # Make xy 0 at center to avoid large values
+    clouds_per_time = [torch.from_numpy(np.concatenate([load_las(
+        x.path, origin=scan.center, center=scan.center, clearance=clearance, shape='square', dtype=np.float32) for x in val])).to(device) for key, val in time_partitions.items()]
+
+    # Apply registration between each cloud and first in list, store transforms
+    # First cloud does not need to be transformed, clouds stay float32 tensors on device throughout
+    clouds_per_time = registration_pipeline(
+        clouds_per_time, voxel_size_icp, voxel_size_final_downsample, cache_dir=registration_cache, backend=registration_backend)
+
+    # Remove below ground and above cutoff
+    # Cut off slightly under ground height
+    ground_cutoff = scan.ground_height - 0.05
+    height_cutoff = ground_cutoff+max_height
+    clouds_per_time = [x[torch.logical_and(
+        x[:, 2] > ground_cutoff, x[:, 2] < height_cutoff), ...] for x in clouds_per_time]
+
+    clouds_per_time = [x.cpu() for x in clouds_per_time]
+
+    store = CloudStore(store_path, mode='w', load_index=False, cell_size=cell_size)
+    store.write_scene(scene_number, clouds_per_time, ground_height=float(scan.ground_height), build=build)
+    return scene_number, store.index[scene_number]
+
+
+# One row per (scene, context cloud, target cloud, voxel) combination of getter_mode 'all'
+COMB_DTYPE = np.dtype([('scene', np.int32), ('cloud_0', np.int16), ('cloud_1', np.int16),
+                       ('voxel', np.int64), ('center', np.float32, (3,))])
+
+
+def context_counts(points, grid, context_size):
+    """Number of points within the context box (as in get_voxel) around every cell center of the grid, one pass over points"""
+    half = context_size.double() / 2
+    size, shape = grid.size, grid.shape
+    cells = grid.cells(points)
+    points = points.double()
+    # How many neighbouring cells on each side can have the point in their context box
+    reach = torch.ceil((half - size / 2) / size).clamp_min(0).long().tolist()
+    per_axis = []
+    for axis in range(3):
+        per_offset = []
+        for offset in range(-reach[axis], reach[axis] + 1):
+            neighbour = cells[:, axis] + offset
+            center = grid.start[axis] + size[axis] / 2 + neighbour * size[axis]
+            inside = (points[:, axis] >= center - half[axis]) & (points[:, axis] <= center + half[axis]) & (
+                neighbour >= 0) & (neighbour < shape[axis])
+            per_offset.append((neighbour, inside))
+        per_axis.append(per_offset)
+    n_cells = int(shape.prod())
+    counts = torch.zeros(n_cells, dtype=torch.long)
+    for (n_x, in_x), (n_y, in_y), (n_z, in_z) in product(*per_axis):
+        inside = in_x & in_y & in_z
+        counts += torch.bincount(grid.cell_keys(torch.stack((n_x[inside], n_y[inside], n_z[inside]), dim=-1)), minlength=n_cells)
+    return counts
+
+
+def mine_scene_combinations(store_path, scene_id, final_voxel_size, context_voxel_size, n_samples_context, min_points=5000):
+    """All (context cloud, target cloud, voxel) combinations of a scene where both clouds have more than n_samples_context
+    points in the voxel and the context box has at least n_samples_context, returned as COMB_DTYPE array"""
+    clouds = CloudStore(store_path)[scene_id]['clouds']
+    clouds = {index: x[:, :3] for index, x in enumerate(clouds) if x.shape[0] > min_points}
+    if len(clouds) < 2:
+        return np.zeros(0, dtype=COMB_DTYPE)
+    start = torch.stack([x.min(dim=0)[0] for x in clouds.values()]).min(dim=0)[0]
+    end = torch.stack([x.max(dim=0)[0] for x in clouds.values()]).max(dim=0)[0]
+    grid = VoxelGrid(start, end, final_voxel_size)
+
+    valid_voxels = {}
+    for index, x in clouds.items():
+        cluster_indices, counts = grid.keys(x).unique(return_counts=True)
+        valid_voxels[index] = cluster_indices[counts > n_samples_context].numpy()
+
+    context = {}
+    scene_combs = []
+    for ind_0, ind_1 in combinations(valid_voxels.keys(), 2):
+        common = np.intersect1d(valid_voxels[ind_0], valid_voxels[ind_1], assume_unique=True)
+        if ind_0 not in context:
+            context[ind_0] = context_counts(clouds[ind_0], grid, context_voxel_size).numpy()
+        common = common[context[ind_0][common] >= n_samples_context]
+        centers = grid.centers(torch.from_numpy(common)).numpy()
+        # Self predict (only on index,since clouds shuffled and 1:1 other to same)
+        for cloud_ind_1 in [ind_1, ind_0]:
+            block = np.zeros(len(common), dtype=COMB_DTYPE)
+            block['scene'] = scene_id
+            block['cloud_0'] = ind_0
+            block['cloud_1'] = cloud_ind_1
+            block['voxel'] = common
+            block['center'] = centers
+            scene_combs.append(block)
+    return np.concatenate(scene_combs)
+
+
+def fps_indices(points, n_samples):
+    """Deterministic farthest point sample (first point as start) of at most n_samples, in selection order"""
+    return fps(points, torch.zeros(points.shape[0]).long(), ratio=n_samples/points.shape[0], random_start=False)[:n_samples]
+
+
+def fps_cache_dtype(n_samples, n_samples_context):
+    """Cached fps orderings of target (fps_1) and context (fps_0) voxel of an all_valid_combs row, padded with -1"""
+    return np.dtype([('fps_1', np.int32, (n_samples,)), ('fps_0', np.int32, (n_samples_context,))])
+
+
+def scene_fps_orders(store_path, combs, final_voxel_size, context_voxel_size, n_samples, n_samples_context):
+    """Fps orderings of the voxels of all_valid_combs rows of a single scene, as fps_cache_dtype array. Since fps has the
+    prefix property any smaller sample is served by slicing"""
+    store = CloudStore(store_path)
+    orders = np.full(len(combs), -1, dtype=fps_cache_dtype(n_samples, n_samples_context))
+    # Each (cloud, voxel) is shared by several rows (e.g. self predict rows)
+    computed = {}
+    for row, comb in enumerate(combs):
+        scene_id, center = int(comb['scene']), torch.from_numpy(np.array(comb['center']))
+        for field, cloud_ind, size, n in [('fps_1', int(comb['cloud_1']), final_voxel_size, n_samples),
+                                          ('fps_0', int(comb['cloud_0']), context_voxel_size, n_samples_context)]:
+            key = (field, cloud_ind, int(comb['voxel']))
+            if key not in computed:
+                computed[key] = fps_indices(store.voxel(scene_id, cloud_ind, center, size), n).numpy()
+            orders[field][row, :len(computed[key])] = computed[key]
+    return orders
+
+
+def collate_voxel_batch(batch):
+    """Collate raw (unsampled) voxels of AmsVoxelLoader with batch_processing, padded to longest with lengths"""
+    collated = {key: [item[key] for item in batch] for key in batch[0]}
+    for key in ['voxel_0', 'voxel_1']:
+        collated[f'lengths_{key[-1]}'] = torch.tensor([x.shape[0] for x in collated[key]])
+        collated[key] = pad_sequence(collated[key], batch_first=True)
+    collated['ground_height'] = torch.tensor(collated['ground_height'], dtype=torch.float32)
+    collated['are_same'] = torch.tensor(collated['are_same'])
+    return collated
 
 
 class Scan:
@@ -59,11 +226,16 @@ class AmsVoxelLoader(Dataset):
     def __init__(self, directory_path_train,directory_path_test, out_path, clearance=10, preload=False,
                  height_min_dif=0.5, max_height=15.0, device="cpu", ground_keep_perc=1/40, n_samples=2048,final_voxel_size=[3., 3., 4.],
                  rotation_augment = True,n_samples_context=2048, context_voxel_size = [3., 3., 4.],
-                mode='train',verbose=False,voxel_size_final_downsample=0.07,getter_mode='sample'):
+                mode='train',verbose=False,voxel_size_final_downsample=0.07,getter_mode='sample',n_workers=0,fps_cache=False,
+                batch_processing=False,registration_backend='open3d',resume=True):
 
         print(f'Dataset mode: {mode}, getter_mode : {getter_mode}')
         self.mode = mode
         self.getter_mode = getter_mode
+        # Items are raw voxels, sampled and normalized per batch by process_batch (use collate_voxel_batch)
+        self.batch_processing = batch_processing
+        if batch_processing and getter_mode != 'all':
+            raise Exception('Batch processing only for getter_mode all')
         if self.mode =='train':
             directory_path = directory_path_train
         elif self.mode == 'test':
@@ -86,7 +258,9 @@ class AmsVoxelLoader(Dataset):
         self.filtered_scan_path = os.path.join  (
             out_path, f'{name_insert}_filtered_scans.pt')
         self.all_valid_combs_path = os.path.join  (
-            out_path, f'{name_insert}_all_valid_combs.pt')
+            out_path, f'{name_insert}_all_valid_combs.npy')
+        self.fps_cache_path = os.path.join(
+            out_path, f'{name_insert}_fps_{n_samples}_{n_samples_context}.npy')
         self.years = [2019, 2020]
         self.ground_keep_perc = ground_keep_perc
         self.over_ground_cutoff = 0.1
@@ -94,6 +268,7 @@ class AmsVoxelLoader(Dataset):
         self.n_samples = n_samples
         self.final_voxel_size = torch.tensor(final_voxel_size)
         save_path = os.path.join(self.out_path, self.save_name)
+        store_path = os.path.join(self.out_path, f'ams_{mode}_store_{clearance}')
         voxel_size_icp = 0.05
 
 
@@ -119,156 +294,176 @@ class AmsVoxelLoader(Dataset):
                 with open(self.filtered_scan_path, "wb") as fp:
                     pickle.dump(self.filtered_scans, fp)
 
-            self.save_dict = {}
-            save_id = -1
-
-            for scene_number, scan in enumerate(tqdm(self.filtered_scans)):
+            # Clouds are sorted by final voxel cell so voxels and contexts are gathered without scanning whole clouds
+            # Unless resume the store is cleared and every scene is processed again
+            self.store = CloudStore(store_path, mode='w', cell_size=self.final_voxel_size.numpy(), resume=resume)
+            scene_args = dict(store_path=store_path, clearance=self.clearance, max_height=max_height,
+                              voxel_size_icp=voxel_size_icp, voxel_size_final_downsample=self.voxel_size_final_downsample,
+                              cell_size=self.store.cell_size, registration_cache=os.path.join(self.out_path, 'registration_cache'),
+                              registration_backend=registration_backend)
+            # Scenes are only reused if built from the same scan with the same parameters (json round trip as in meta.json)
+            build = json.loads(json.dumps({key: val.tolist() if isinstance(val, np.ndarray) else val for key, val in scene_args.items()
+                                           if key not in ['store_path', 'registration_cache']}))
+            scene_builds = [dict(build, scan=scan.id) for scan in self.filtered_scans]
+            for scene_number in self.store.scene_ids():
+                if scene_number >= len(scene_builds) or self.store.index[scene_number].get('build') != scene_builds[scene_number]:
+                    self.store.remove_scene(scene_number)
+            # Scene ids are positions in filtered_scans (which are cached), scenes with a shard already are skipped
+            todo = [(scene_number, scan) for scene_number, scan in enumerate(self.filtered_scans) if scene_number not in self.store]
+            print(f'{len(self.filtered_scans)-len(todo)} scenes already processed, {len(todo)} to go')
+            if len(todo) > 0:
+                # Combinations (and fps orderings of them) are mined from the scenes
+                for path in [self.all_valid_combs_path, self.fps_cache_path]:
+                    if os.path.isfile(path):
+                        os.remove(path)
+
+            def scene_jobs():
                 # Gather scans within certain distance of scan center
-                relevant_scans = [x for x in self.scans if np.linalg.norm(
-                    x.center-scan.center) < 7]
-
-                relevant_times = set([x.datetime for x in relevant_scans])
-
-                # Group by dates
-                time_partitions = {time: [
-                    x for x in relevant_scans if x.datetime == time] for time in relevant_times}
-
-                # Load and combine clouds from same date
-                clouds_per_time = [torch.from_numpy(np.concatenate([load_las(
-                    x.path) for x in val])).double().to(device) for key, val in time_partitions.items()]
-
-                # Make xy 0 at center to avoid large values
-                center_trans = torch.cat(
-                    (torch.from_numpy(scan.center), torch.tensor([0, 0, 0, 0]))).double().to(device)
-                
-                clouds_per_time = [x-center_trans for x in clouds_per_time]
-                # Extract square at center since only those will be used for grid
-                clouds_per_time = [x[extract_area(x, center=np.array(
-                    [0, 0]), clearance=self.clearance, shape='square'), :] for x in clouds_per_time]
-                # Apply registration between each cloud and first in list, store transforms
-                # First cloud does not need to be transformed
-                
-
-                clouds_per_time = registration_pipeline(
-                    clouds_per_time, voxel_size_icp, self.voxel_size_final_downsample)
-
-               
-                # Remove below ground and above cutoff
-                # Cut off slightly under ground height
-        
-
-                ground_cutoff = scan.ground_height - 0.05 
-                height_cutoff = ground_cutoff+max_height 
-                clouds_per_time = [x[torch.logical_and(
-                    x[:, 2] > ground_cutoff, x[:, 2] < height_cutoff), ...] for x in clouds_per_time]
-
-                clouds_per_time = [x.float().cpu() for x in clouds_per_time]
-
-                save_id += 1
-                save_entry = {'clouds': clouds_per_time,
-                              'ground_height': scan.ground_height}
-
-                self.save_dict[save_id] = save_entry
-                if scene_number % 100 == 0 and scene_number != 0:
-                    print(f"Progressbackup: {scene_number}!")
-                    torch.save(self.save_dict, save_path)
-
-            print(f"Saving to {save_path}!")
-            torch.save(self.save_dict, save_path)
+                all_relevant_scans = ScanIndex(self.scans).relevant_scans([scan for _, scan in todo], 7)
+                for (scene_number, scan), relevant_scans in zip(todo, all_relevant_scans):
+                    yield scene_number, scan, relevant_scans
+
+            if n_workers > 0:
+                # Workers are cpu only, each writes its own scene shard
+                with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                    futures = {executor.submit(process_scene, scene_number, scan, relevant_scans, device='cpu',
+                                               build=scene_builds[scene_number], **scene_args): scene_number
+                               for scene_number, scan, relevant_scans in scene_jobs()}
+                    for future in tqdm(as_completed(futures), total=len(futures)):
+                        try:
+                            scene_number, entry = future.result()
+                            self.store.index[scene_number] = entry
+                        except Exception as e:
+                            print(f'Failed processing scene {futures[future]}: {e}')
+            else:
+                for scene_number, scan, relevant_scans in tqdm(scene_jobs(), total=len(todo)):
+                    scene_number, entry = process_scene(scene_number, scan, relevant_scans, device=device,
+                                                        build=scene_builds[scene_number], **scene_args)
+                    self.store.index[scene_number] = entry
+
+            print(f"Saved to {store_path}!")
+            self.store.write_index()
+            self.store = CloudStore(store_path)
         else:
-            self.save_dict = torch.load(save_path)
+            self.store = open_store(store_path, legacy_path=save_path, cell_size=self.final_voxel_size.numpy())
+        self.scene_ids = self.store.scene_ids()
 
 
         if self.getter_mode == 'all':
             
             if os.path.isfile(self.all_valid_combs_path):
-                self.all_valid_combs = torch.load(self.all_valid_combs_path)
+                self.all_valid_combs = np.load(self.all_valid_combs_path, mmap_mode='r')
             else:
-                self.all_valid_combs = []
-                for idx, (save_id,save_entry) in enumerate(tqdm(self.save_dict.items())):
-                    clouds = save_entry['clouds']     
-                    clouds = {index:x for index,x in enumerate(clouds) if x.shape[0] > 5000}
-                    
-                    if len(clouds) < 2:
-                        if self.verbose:
-                            print(f'Not enough clouds {idx}, skipping ')
-                        continue
-                    
-                    cluster_min = torch.stack([torch.min(x,dim=0)[0][:3] for x in clouds.values()]).min(dim=0)[0]
-                    cluster_max = torch.stack([torch.max(x,dim=0)[0][:3] for x in clouds.values()]).max(dim=0)[0]
-                    clusters = {}
-                    for index,x in clouds.items():
-                        labels,voxel_centers = voxelize(x[:, :3],start= cluster_min,end=cluster_max,size= self.final_voxel_size)
-                        clusters[index] = labels
-    
-                   
-
-                  
-                    valid_voxels = {}
-                    for ind,cluster in clusters.items():
-                        cluster_indices, counts = cluster.unique(return_counts=True)
-                        valid_indices = cluster_indices[counts > self.n_samples_context]
-                        valid_voxels[ind] = valid_indices
-                    common_voxels = []
-                    for ind_0, ind_1 in combinations(valid_voxels.keys(), 2):
-                        if ind_0 == ind_1:
-                            continue
-                        common_voxels.append([ind_0, ind_1,[x.item() for x in valid_voxels[ind_0] if x in valid_voxels[ind_1]]  ])
-                    valid_combs = []
-                    for val in common_voxels:
-                        valid_combs.extend([(val[0], val[1], x) for x in val[2]])
-                        # Self predict (only on index,since clouds shuffled and 1:1 other to same)
-                        valid_combs.extend([(val[0], val[0], x) for x in val[2]])
-
-                    if len(valid_combs) < 1:
-                        # If not enough recursively give other index from dataset
-                        continue
-                    
-
-                 
-                    
-                    for draw_ind,draw in enumerate(valid_combs):
-                        
-                       
-                        voxel_center = voxel_centers[draw[2]]
-                        cloud_ind_0 = draw[0]
-                        voxel_0 = get_voxel(clouds[cloud_ind_0],voxel_center,self.context_voxel_size)
-                        if voxel_0.shape[0]>=self.n_samples_context:
-                            final_comb = (save_id,draw[0],draw[1],draw[2])
-                            self.all_valid_combs.append({'combination':final_comb,'voxel_center':voxel_center})
-                        else:
-                            print('Invalid')
-                            continue
-                        
-                
-                    
-                        
-                
-                n_same =0
-                n_dif = 0
-                for comb_dict in self.all_valid_combs:
-                    if comb_dict['combination'][1] == comb_dict['combination'][2]:
-                        n_same+=1
-                    else:
-                        n_dif +=1
-                print(f"n_same/n_dif: {n_same/n_dif}")
-
-                
-                torch.save(self.all_valid_combs,self.all_valid_combs_path)
-                        
-                    
+                mine = partial(mine_scene_combinations, self.store.path, final_voxel_size=self.final_voxel_size,
+                               context_voxel_size=self.context_voxel_size, n_samples_context=self.n_samples_context)
+                if n_workers > 0:
+                    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                        scene_combs = list(tqdm(executor.map(mine, self.scene_ids, chunksize=16), total=len(self.scene_ids)))
+                else:
+                    scene_combs = [mine(x) for x in tqdm(self.scene_ids)]
+                self.all_valid_combs = np.concatenate([np.zeros(0, dtype=COMB_DTYPE)] + scene_combs)
+
+                n_same = int((self.all_valid_combs['cloud_0'] == self.all_valid_combs['cloud_1']).sum())
+                n_dif = len(self.all_valid_combs) - n_same
+                print(f"n_same/n_dif: {n_same/max(n_dif, 1)}")
+
+                np.save(self.all_valid_combs_path, self.all_valid_combs)
+                self.all_valid_combs = np.load(self.all_valid_combs_path, mmap_mode='r')
+                # Orderings index voxels of the previous combinations
+                if os.path.isfile(self.fps_cache_path):
+                    os.remove(self.fps_cache_path)
+
+        self.fps_cache = None
+        if self.getter_mode == 'all' and fps_cache:
+            if not os.path.isfile(self.fps_cache_path):
+                self.build_fps_cache(n_workers)
+            self.fps_cache = np.load(self.fps_cache_path, mmap_mode='r')
 
         print('Loaded dataset!')
 
+    def build_fps_cache(self, n_workers=0):
+        """Precompute fps orderings of all combinations per scene, rows that fail stay -1 and are sampled on the fly"""
+        print(f'Building fps cache at {self.fps_cache_path}')
+        tmp_path = self.fps_cache_path + '.tmp.npy'
+        cache = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=fps_cache_dtype(
+            self.n_samples, self.n_samples_context), shape=(len(self.all_valid_combs),))
+        cache[:] = -1
+        # Combinations are mined scene by scene so each scene is a contiguous block of rows
+        scenes, starts = np.unique(self.all_valid_combs['scene'], return_index=True)
+        bounds = np.append(np.sort(starts), len(self.all_valid_combs))
+        orders = partial(scene_fps_orders, self.store.path, final_voxel_size=self.final_voxel_size, context_voxel_size=self.context_voxel_size,
+                         n_samples=self.n_samples, n_samples_context=self.n_samples_context)
+        blocks = list(zip(bounds[:-1], bounds[1:]))
+        if n_workers > 0:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = {executor.submit(orders, np.array(self.all_valid_combs[start:end])): (start, end) for start, end in blocks}
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    start, end = futures[future]
+                    try:
+                        cache[start:end] = future.result()
+                    except Exception as e:
+                        print(f'Failed fps for rows {start}-{end}: {e}')
+        else:
+            for start, end in tqdm(blocks):
+                cache[start:end] = orders(np.array(self.all_valid_combs[start:end]))
+        cache.flush()
+        del cache
+        os.replace(tmp_path, self.fps_cache_path)
+
+    def sample_fps(self, voxel, n_samples, cached=None):
+        """Fps sample of voxel, from cached ordering if there is one"""
+        if cached is not None and cached[0] >= 0:
+            return voxel[torch.from_numpy(cached[:n_samples][cached[:n_samples] >= 0].astype(np.int64))]
+        return voxel[fps_indices(voxel, n_samples)]
+
+    def raw_getter(self, idx):
+        """Unprocessed voxels of combination idx, fps sampled only if cached (cheap slicing)"""
+        comb = self.all_valid_combs[idx]
+        save_id,cloud_ind_0,cloud_ind_1 = int(comb['scene']),int(comb['cloud_0']),int(comb['cloud_1'])
+        center = torch.from_numpy(np.array(comb['center']))
+        voxel_1 = self.store.voxel(save_id,cloud_ind_1,center,self.final_voxel_size)
+        voxel_0 = self.store.voxel(save_id,cloud_ind_0,center,self.context_voxel_size)
+        if self.fps_cache is not None and self.fps_cache[idx]['fps_1'][0] >= 0 and self.fps_cache[idx]['fps_0'][0] >= 0:
+            voxel_1 = self.sample_fps(voxel_1, self.n_samples, self.fps_cache[idx]['fps_1'])
+            voxel_0 = self.sample_fps(voxel_0, self.n_samples_context, self.fps_cache[idx]['fps_0'])
+        return {'voxel_0': voxel_0, 'voxel_1': voxel_1, 'ground_height': self.store.index[save_id]['ground_height'],
+                'are_same': cloud_ind_0 == cloud_ind_1}
+
+    def process_batch(self, batch, device):
+        """Batched fps, augmentation, joint normalization and rotation of collate_voxel_batch output on device,
+        returns same batch as the default getter"""
+        batch = {key: val.to(device) for key, val in batch.items()}
+        tensor_0, tensor_1 = batch['voxel_0'], batch['voxel_1']
+        if (batch['lengths_1'] != self.n_samples).any() or tensor_1.shape[1] != self.n_samples:
+            tensor_1 = tensor_1[torch.arange(tensor_1.shape[0], device=device).unsqueeze(1), batched_fps(tensor_1, batch['lengths_1'], self.n_samples)]
+        if (batch['lengths_0'] != self.n_samples_context).any() or tensor_0.shape[1] != self.n_samples_context:
+            tensor_0 = tensor_0[torch.arange(tensor_0.shape[0], device=device).unsqueeze(1), batched_fps(tensor_0, batch['lengths_0'], self.n_samples_context)]
+        #Only augment in train
+        if self.mode == 'train':
+            jitter = torch.rand_like(tensor_0[..., :3])*0.01*batch['are_same'][:, None, None]
+            tensor_0 = torch.cat((tensor_0[..., :3] + jitter, tensor_0[..., 3:]), dim=-1)
+
+        tensor_0, tensor_1, inverse = batched_co_unit_sphere(tensor_0, tensor_1)
+
+        if self.mode == 'train' and self.rotation_augment:
+            rot_mat = batched_rotate_xy(torch.rand(tensor_0.shape[0], device=device)*math.pi*2)
+            tensor_0 = torch.cat((torch.bmm(tensor_0[..., :2], rot_mat), tensor_0[..., 2:]), dim=-1)
+            tensor_1 = torch.cat((torch.bmm(tensor_1[..., :2], rot_mat), tensor_1[..., 2:]), dim=-1)
+
+        # Distance from ground as extra context
+        extra_context = (inverse['mean'][:, 2] - batch['ground_height']).unsqueeze(-1)
+        return [tensor_0, tensor_1, extra_context]
+
     def __len__(self):
         if self.getter_mode =='sample':
-            return len(self.save_dict)
+            return len(self.scene_ids)
         elif self.getter_mode == 'all':
             return len(self.all_valid_combs)
 
     def sample_voxel_pairs(self,idx):
-        clouds = self.save_dict[idx]['clouds']
-        ground_height = self.save_dict[idx]['ground_height']
+        scene = self.store[self.scene_ids[idx]]
+        clouds = scene['clouds']
+        ground_height = scene['ground_height']
         random.shuffle(clouds)
         
         clouds = [x for x in clouds if x.shape[0] > 5000]
@@ -276,10 +471,11 @@ class AmsVoxelLoader(Dataset):
             if self.verbose:
                 print(f'Not enough clouds {idx}, recursive return ')
             return self.__getitem__(random.randint(0, self.__len__()-1))
-        cluster_min = clouds[0].min(axis=0)[0][:3]
-        cluster_max = clouds[0].max(axis=0)[0][:3]
-        clusters = [torch_cluster.grid_cluster(
-            x[:, :3],start= cluster_min,end=cluster_max,size= self.final_voxel_size) for x in clouds]
+        # Grid over all clouds so no points of other clouds fall outside it
+        cluster_min = torch.stack([x.min(axis=0)[0][:3] for x in clouds]).min(axis=0)[0]
+        cluster_max = torch.stack([x.max(axis=0)[0][:3] for x in clouds]).max(axis=0)[0]
+        grid = VoxelGrid(cluster_min, cluster_max, self.final_voxel_size)
+        clusters = [grid.keys(x[:, :3]) for x in clouds]
 
         valid_voxels = []
         for cluster in clusters:
@@ -313,7 +509,7 @@ class AmsVoxelLoader(Dataset):
             indices = clusters[cloud_ind_1] == draw[2]
             
             voxel_1 = clouds[cloud_ind_1][indices, :]
-            voxel_center = get_voxel_center(voxel_1[0,:3],cluster_min,self.final_voxel_size)
+            voxel_center = grid.centers(torch.tensor(draw[2])).float()
             cloud_ind_0 = draw[0]
             voxel_0 = get_voxel(clouds[cloud_ind_0],voxel_center,self.context_voxel_size)
             if not voxel_0.shape[0]>=self.n_samples_context:
@@ -363,34 +559,25 @@ class AmsVoxelLoader(Dataset):
 
 
 
-        save_id,cloud_ind_0,cloud_ind_1,common_voxel = self.all_valid_combs[idx]['combination']
-        ground_height = self.save_dict[save_id]['ground_height']
-        clouds = self.save_dict[save_id]['clouds']
-        center = self.all_valid_combs[idx]['voxel_center']
+        comb = self.all_valid_combs[idx]
+        save_id,cloud_ind_0,cloud_ind_1 = int(comb['scene']),int(comb['cloud_0']),int(comb['cloud_1'])
+        ground_height = self.store.index[save_id]['ground_height']
+        center = torch.from_numpy(np.array(comb['center']))
         are_same = (cloud_ind_1 == cloud_ind_0)
         
         
-        cloud_0,cloud_1 = clouds[cloud_ind_0],clouds[cloud_ind_1]
-
-    
-        voxel_1 = get_voxel(cloud_1,center,self.final_voxel_size)
-        voxel_0 = get_voxel(cloud_0,center,self.context_voxel_size)
+        # Only the cells covering each box are read from the (voxel sorted) clouds
+        voxel_1 = self.store.voxel(save_id,cloud_ind_1,center,self.final_voxel_size)
+        voxel_0 = self.store.voxel(save_id,cloud_ind_0,center,self.context_voxel_size)
         
         
         
         
      
 
-        voxel_1 = voxel_1[fps(voxel_1, torch.zeros(voxel_1.shape[0]).long(
-        ), ratio=self.n_samples/voxel_1.shape[0], random_start=False), :]
-        voxel_1 = voxel_1[:self.n_samples, :]
-
-        
-        
-    
-        voxel_0 = voxel_0[fps(voxel_0, torch.zeros(voxel_0.shape[0]).long(
-        ), ratio=self.n_samples_context/voxel_0.shape[0], random_start=False), :]
-        voxel_0 = voxel_0[:self.n_samples_context,:]
+        cached = self.fps_cache[idx] if self.fps_cache is not None else None
+        voxel_1 = self.sample_fps(voxel_1, self.n_samples, None if cached is None else cached['fps_1'])
+        voxel_0 = self.sample_fps(voxel_0, self.n_samples_context, None if cached is None else cached['fps_0'])
         #Only augment in train
         if are_same:
             voxel_1 = voxel_1.clone()
@@ -423,6 +610,8 @@ class AmsVoxelLoader(Dataset):
         if self.getter_mode == 'sample':
             return self.sample_voxel_pairs(idx)
         elif self.getter_mode == 'all':
+            if self.batch_processing:
+                return self.raw_getter(idx)
             return self.all_getter(idx)
         
         
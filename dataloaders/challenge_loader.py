@@ -7,11 +7,12 @@ from torch_geometric.nn import fps
 from tqdm import tqdm
 import pandas as pd
 from .dataset_utils import registration_pipeline,context_voxel_center
+from .cloud_store import CloudStore, open_store
 class ChallengeDataset(Dataset):
     def __init__(self, csv_path,direcories_list,out_path,
     n_samples=2000,n_samples_context=2048,
     preload=False,device="cuda",context_voxel_size = [3., 3., 4.],
-    final_voxel_size=[3., 3., 4.]):
+    final_voxel_size=[3., 3., 4.],registration_backend='open3d'):
         self.n_samples  = n_samples
         self.out_path = out_path
         self.voxel_size = 0.07
@@ -20,6 +21,7 @@ class ChallengeDataset(Dataset):
         self.final_voxel_size = torch.tensor(final_voxel_size)
         self.save_name = f"challenge_{self.voxel_size}.pt"
         save_path  = os.path.join(self.out_path,self.save_name)
+        store_path = os.path.join(self.out_path,f"challenge_store_{self.voxel_size}")
         self.class_labels = ['nochange','removed',"added",'change',"color_change"]
         self.class_int_dict = {x:self.class_labels.index(x) for x in self.class_labels}
         self.int_class_dict = {val:key for key,val in self.class_int_dict.items()}
@@ -37,23 +39,23 @@ class ChallengeDataset(Dataset):
             
             
             
-            self.loaded_clouds = {}
+            store = CloudStore(store_path,mode='w',cell_size=self.final_voxel_size.numpy())
             for scene_num, scene_path_list in tqdm(combined_scene_dicts.items()):
                 
                 
                 scene_list = [torch.from_numpy(load_las(scene_path_list[x])).double().to(device) for x in range(2)] 
-                self.loaded_clouds[scene_num] = registration_pipeline(scene_list,voxel_size_icp,self.voxel_size)
-                self.loaded_clouds[scene_num] = [x.float() for x in self.loaded_clouds[scene_num]]
+                registered = registration_pipeline(scene_list,voxel_size_icp,self.voxel_size,cache_dir=os.path.join(self.out_path,'registration_cache'),backend=registration_backend)
+                store.write_scene(scene_num,[x.float() for x in registered])
                 
-            print(f"Saving to {save_path}!")
-            torch.save(self.loaded_clouds,save_path)
+            print(f"Saved to {store_path}!")
+            store.write_index()
+            self.loaded_clouds = CloudStore(store_path)
         else:
-            self.loaded_clouds = torch.load(save_path,map_location='cpu')
+            self.loaded_clouds = open_store(store_path,legacy_path=save_path,cell_size=self.final_voxel_size.numpy())
         self.pair_dict={}
         pair_id = 0
         for index, row in df.iterrows():
             scene_num = row['scene']
-            scene_path_list=self.loaded_clouds[scene_num]
             label = self.class_int_dict[row['classification']]
             center = torch.Tensor([row['x'],row["y"]]).to('cpu')
             
@@ -105,8 +107,12 @@ class ChallengeDataset(Dataset):
     def __getitem__(self, idx):
         return_dict = {}
         scene_num,center,label = self.pair_dict[idx]
+        # Gather the full height column around center from the (voxel sorted) store, then crop exactly
+        column_center = torch.cat((center,torch.zeros(1)))
+        column_size = torch.Tensor([2*self.context_voxel_size[0].item()]*2+[float('inf')])
+        cloud_0,cloud_1 = [self.loaded_clouds.voxel(scene_num,x,column_center,column_size) for x in range(2)]
         cloud_0,cloud_1 = [x[extract_area(x,center,self.context_voxel_size[0].item(),
-        shape='square'),:] for x in self.loaded_clouds[scene_num]]
+        shape='square'),:] for x in [cloud_0,cloud_1]]
         z_max = max(cloud_0[:,2].max(),cloud_1[:,2].max())
         z_min = min(cloud_0[:,2].min(),cloud_1[:,2].min())
         
@@ -0,0 +1,211 @@
+import os
+import json
+import shutil
+import warnings
+import numpy as np
+import torch
+from utils import get_voxel, VoxelGrid
+
+
+class CloudStore:
+    """Directory store of processed clouds, one memory-mappable .npy file per (scene, epoch) cloud plus a small json index.
+    Every scene lives in its own directory which is written to a temporary name and renamed when complete.
+    mode 'w' starts from an empty store unless resume, then completed scenes are kept and the index is recovered from
+    their directories. load_index=False (writers of single scenes of a build in progress) leaves the store as is.
+    If cell_size is given clouds are stored sorted by grid cell with a CSR table (occupied cell keys, offsets) so boxes
+    can be gathered as a few contiguous slices"""
+
+    index_name = 'index.json'
+
+    def __init__(self, path, mode='r', load_index=True, cell_size=None, resume=False):
+        self.path = path
+        self.mode = mode
+        self.cell_size = None if cell_size is None else np.asarray(cell_size, dtype=np.float32)
+        if mode == 'w':
+            os.makedirs(self.path, exist_ok=True)
+            if load_index and not resume:
+                self.clear()
+            elif load_index and os.path.isfile(os.path.join(self.path, self.index_name)):
+                # Index is rewritten once writing is done, until then the store is incomplete
+                os.remove(os.path.join(self.path, self.index_name))
+        elif not os.path.isfile(os.path.join(self.path, self.index_name)):
+            raise FileNotFoundError(f'No complete cloud store at {self.path}')
+        self.index = self._load_index() if load_index else {}
+        self._mapped = {}
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, CloudStore.index_name))
+
+    def clear(self):
+        """Remove all scenes (also partially written ones) and the index"""
+        for name in os.listdir(self.path):
+            if name.startswith('scene_'):
+                shutil.rmtree(os.path.join(self.path, name))
+        if os.path.isfile(os.path.join(self.path, self.index_name)):
+            os.remove(os.path.join(self.path, self.index_name))
+
+    def scene_dir(self, scene_id):
+        return os.path.join(self.path, f'scene_{scene_id}')
+
+    def _load_index(self):
+        index_path = os.path.join(self.path, self.index_name)
+        if self.mode == 'r':
+            with open(index_path) as f:
+                return {int(key): val for key, val in json.load(f).items()}
+        # Writing, empty unless resuming an interrupted build, recover it from the completed scene directories
+        index = {}
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                meta_path = os.path.join(self.path, name, 'meta.json')
+                if name.startswith('scene_') and not name.endswith('.tmp') and os.path.isfile(meta_path):
+                    with open(meta_path) as f:
+                        index[int(name.split('_')[-1])] = json.load(f)
+        return index
+
+    def write_index(self):
+        """Atomically write index of all scenes"""
+        index_path = os.path.join(self.path, self.index_name)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({str(key): val for key, val in sorted(self.index.items())}, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def write_scene(self, scene_id, clouds, **meta):
+        """Write clouds of a scene with extra json serializable meta data (e.g. ground_height)"""
+        if self.mode != 'w':
+            raise Exception('Cloud store opened read only')
+        scene_dir = self.scene_dir(scene_id)
+        tmp_dir = scene_dir + '.tmp'
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        clouds = [x.detach().cpu().numpy() if isinstance(x, torch.Tensor) else x for x in clouds]
+        clouds = [np.ascontiguousarray(x, dtype=np.float32) for x in clouds]
+        entry = {'n_points': [int(x.shape[0]) for x in clouds], **meta}
+        if self.cell_size is not None and sum(entry['n_points']) > 0:
+            origin = np.stack([x[:, :3].min(axis=0) for x in clouds if x.shape[0] > 0]).min(axis=0)
+            end = np.stack([x[:, :3].max(axis=0) for x in clouds if x.shape[0] > 0]).max(axis=0)
+            shape = np.floor((end - origin) / self.cell_size).astype(np.int64) + 1
+            entry['grid'] = {'origin': origin.tolist(), 'cell_size': self.cell_size.tolist(), 'shape': shape.tolist()}
+        for cloud_ind, cloud in enumerate(clouds):
+            if 'grid' in entry:
+                keys = self._cell_keys(cloud[:, :3], entry['grid'])
+                order = np.argsort(keys, kind='stable')
+                cloud, keys = cloud[order], keys[order]
+                occupied, starts = np.unique(keys, return_index=True)
+                np.save(os.path.join(tmp_dir, f'cloud_{cloud_ind}_keys.npy'), occupied)
+                np.save(os.path.join(tmp_dir, f'cloud_{cloud_ind}_offsets.npy'), np.append(starts, len(keys)).astype(np.int64))
+            np.save(os.path.join(tmp_dir, f'cloud_{cloud_ind}.npy'), cloud)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(entry, f)
+        if os.path.isdir(scene_dir):
+            shutil.rmtree(scene_dir)
+        os.rename(tmp_dir, scene_dir)
+        self.index[scene_id] = entry
+        self._mapped.pop(scene_id, None)
+
+    def remove_scene(self, scene_id):
+        if self.mode != 'w':
+            raise Exception('Cloud store opened read only')
+        if os.path.isdir(self.scene_dir(scene_id)):
+            shutil.rmtree(self.scene_dir(scene_id))
+        self.index.pop(scene_id, None)
+        self._mapped.pop(scene_id, None)
+
+    def cloud(self, scene_id, cloud_ind):
+        """Memory mapped (copy on write) cloud as tensor, pages are shared between processes until written"""
+        mapped = self._mapped.setdefault(scene_id, {})
+        if cloud_ind not in mapped:
+            array = np.load(os.path.join(self.scene_dir(scene_id), f'cloud_{cloud_ind}.npy'), mmap_mode='c')
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                mapped[cloud_ind] = torch.from_numpy(array)
+        return mapped[cloud_ind]
+
+    @staticmethod
+    def _cell_keys(points, grid):
+        """Linear (x fastest) cell key of points"""
+        return VoxelGrid(grid['origin'], None, grid['cell_size'], shape=grid['shape']).keys(torch.from_numpy(points)).numpy()
+
+    def _csr(self, scene_id, cloud_ind):
+        mapped = self._mapped.setdefault(scene_id, {})
+        if ('csr', cloud_ind) not in mapped:
+            scene_dir = self.scene_dir(scene_id)
+            mapped[('csr', cloud_ind)] = (np.load(os.path.join(scene_dir, f'cloud_{cloud_ind}_keys.npy'), mmap_mode='r'),
+                                          np.load(os.path.join(scene_dir, f'cloud_{cloud_ind}_offsets.npy'), mmap_mode='r'))
+        return mapped[('csr', cloud_ind)]
+
+    def cell_slices(self, scene_id, cloud_ind, box_min, box_max):
+        """Contiguous row ranges of the cells overlapping box [box_min, box_max], one per (y, z) cell row"""
+        grid = self.index[scene_id]['grid']
+        origin, cell_size, shape = [np.asarray(grid[x]) for x in ['origin', 'cell_size', 'shape']]
+        # Small margin so points on a box face are never lost to float32/float64 rounding at cell borders
+        # Unbounded (inf) box sides are clipped to the grid before casting
+        low = np.clip(np.floor((np.asarray(box_min, dtype=np.float64) - origin) / cell_size - 1e-4), -1, shape).astype(np.int64)
+        high = np.clip(np.floor((np.asarray(box_max, dtype=np.float64) - origin) / cell_size + 1e-4), -1, shape).astype(np.int64)
+        if (high < 0).any() or (low >= shape).any():
+            return []
+        low, high = np.clip(low, 0, shape - 1), np.clip(high, 0, shape - 1)
+        keys, offsets = self._csr(scene_id, cloud_ind)
+        y, z = np.meshgrid(np.arange(low[1], high[1] + 1), np.arange(low[2], high[2] + 1), indexing='ij')
+        row_keys = shape[0] * (y.ravel() + shape[1] * z.ravel())
+        starts = np.searchsorted(keys, row_keys + low[0], side='left')
+        ends = np.searchsorted(keys, row_keys + high[0], side='right')
+        return [(offsets[start], offsets[end]) for start, end in zip(starts, ends) if end > start]
+
+    def voxel(self, scene_id, cloud_ind, center, dimensions):
+        """Points of cloud within box of dimensions at center (as get_voxel), gathering only the overlapping cells if sorted"""
+        cloud = self.cloud(scene_id, cloud_ind)
+        if 'grid' not in self.index[scene_id]:
+            return get_voxel(cloud, center, dimensions)
+        center, dimensions = torch.as_tensor(center), torch.as_tensor(dimensions)
+        slices = self.cell_slices(scene_id, cloud_ind, (center - dimensions / 2).numpy(), (center + dimensions / 2).numpy())
+        if len(slices) == 0:
+            return cloud[:0].clone()
+        gathered = torch.cat([cloud[start:end] for start, end in slices])
+        return get_voxel(gathered, center, dimensions)
+
+    def scene_ids(self):
+        return sorted(self.index.keys())
+
+    def __getitem__(self, scene_id):
+        entry = dict(self.index[scene_id])
+        entry['clouds'] = [self.cloud(scene_id, cloud_ind) for cloud_ind in range(len(entry.pop('n_points')))]
+        return entry
+
+    def __contains__(self, scene_id):
+        return scene_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def items(self):
+        for scene_id in self.scene_ids():
+            yield scene_id, self[scene_id]
+
+    def __getstate__(self):
+        # Memory maps are reopened lazily after pickling (e.g. spawned workers)
+        state = self.__dict__.copy()
+        state['_mapped'] = {}
+        return state
+
+
+def migrate_save_dict(legacy_path, store_path, cell_size=None):
+    """Convert a legacy torch.save'd dict of scenes ({id: {'clouds': [...], ...}} or {id: [clouds]}) to a CloudStore"""
+    print(f'Converting {legacy_path} to cloud store at {store_path}')
+    save_dict = torch.load(legacy_path, map_location='cpu')
+    store = CloudStore(store_path, mode='w', cell_size=cell_size)
+    for scene_id, entry in save_dict.items():
+        if not isinstance(entry, dict):
+            entry = {'clouds': entry}
+        meta = {key: float(val) if isinstance(val, (torch.Tensor, np.floating)) else val for key, val in entry.items() if key != 'clouds'}
+        store.write_scene(int(scene_id), entry['clouds'], **meta)
+    store.write_index()
+    return CloudStore(store_path)
+
+
+def open_store(store_path, legacy_path=None, cell_size=None):
+    """Open store read only, migrating legacy .pt save if only that exists"""
+    if not CloudStore.exists(store_path) and legacy_path is not None and os.path.isfile(legacy_path):
+        return migrate_save_dict(legacy_path, store_path, cell_size=cell_size)
+    return CloudStore(store_path)
@@ -1,7 +1,13 @@
 
+import os
+import hashlib
 import torch
 import numpy as np
 import open3d as o3d
+from concurrent.futures import ThreadPoolExecutor
+from torch.nn.utils.rnn import pad_sequence
+from utils import VoxelGrid
+from .torch_icp import batched_icp, estimate_normals
 
 
 def context_voxel_center(voxel):
@@ -13,46 +19,102 @@ def context_voxel_center(voxel):
     return approx_center
 
 
-def icp_reg_precomputed_target(source_cloud, target, voxel_size=0.05, max_it=2000):
-    """Perform icp of target with source_cloud where source_cloud already has normals"""
-    source_cloud = source_cloud.cpu().numpy()
-    
+def to_o3d(cloud):
+    """Open3D point cloud of (n,6) xyzrgb tensor/array"""
+    if isinstance(cloud, torch.Tensor):
+        cloud = cloud.detach().cpu().numpy()
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(cloud[:, :3])
+    pcd.colors = o3d.utility.Vector3dVector(cloud[:, 3:])
+    return pcd
+
+
+def cloud_digest(cloud):
+    """Content hash of cloud (values, dtype and shape)"""
+    if isinstance(cloud, torch.Tensor):
+        cloud = cloud.detach().cpu().numpy()
+    cloud = np.ascontiguousarray(cloud)
+    digest = hashlib.blake2b(f'{cloud.dtype}{cloud.shape}'.encode(), digest_size=16)
+    digest.update(cloud)
+    return digest.hexdigest()
+
+
+def voxel_downsample(cloud, voxel_size):
+    """Average of points (and colors) per occupied voxel as Open3D voxel_down_sample, on cloud's device and dtype"""
+    if cloud.shape[0] == 0:
+        return cloud
+    half = voxel_size / 2
+    grid = VoxelGrid(cloud[:, :3].min(dim=0)[0] - half, cloud[:, :3].max(dim=0)[0] + half, [voxel_size] * 3)
+    occupied, labels = grid.occupy(cloud[:, :3])
+    sums = torch.zeros((len(occupied), cloud.shape[1]), dtype=cloud.dtype, device=cloud.device).index_add_(0, labels, cloud)
+    counts = torch.bincount(labels, minlength=len(occupied)).to(cloud.dtype)
+    return sums / counts.unsqueeze(-1)
+
+
+def transform_cloud(cloud, transform):
+    """Apply 4x4 rigid transform to xyz of cloud in place"""
+    transform = torch.as_tensor(transform, dtype=cloud.dtype, device=cloud.device)
+    cloud[:, :3] = cloud[:, :3] @ transform[:3, :3].T + transform[:3, 3]
+    return cloud
+
+
+def downsample_with_normals(cloud, voxel_size):
+    """Downsampled Open3D cloud with normals, as used in icp"""
+    pcd = to_o3d(voxel_downsample(cloud, voxel_size))
+    pcd.estimate_normals()
+    return pcd
+
+
+def icp_reg_precomputed_target(source_cloud, target, voxel_size=0.05, max_it=2000, trans_init=None):
+    """Perform icp of target with source_cloud where target already has normals"""
     threshold = voxel_size * 0.4
-    trans_init = np.eye(4).astype(np.float32)
-    source = o3d.geometry.PointCloud()
-    source.points = o3d.utility.Vector3dVector(source_cloud[:, :3])
-    source.colors = o3d.utility.Vector3dVector(source_cloud[:, 3:])
-    source = source.voxel_down_sample(voxel_size)
-    source.estimate_normals()
+    trans_init = np.eye(4).astype(np.float32) if trans_init is None else trans_init
+    source = downsample_with_normals(source_cloud, voxel_size)
     result = o3d.pipelines.registration.registration_icp(
         source, target, threshold, trans_init,
         o3d.pipelines.registration.TransformationEstimationPointToPlane(), o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=max_it))
 
     return result
 
+
+def icp_coarse_to_fine(source_cloud, target_pyramid, voxel_size, scales, max_it=2000):
+    """Icp over decreasing voxel sizes (voxel_size*scale), each level starting from the previous transform so the
+    finest (most expensive) level converges in few iterations. target_pyramid has a target with normals per scale"""
+    transform = None
+    for scale, target in zip(scales, target_pyramid):
+        result = icp_reg_precomputed_target(source_cloud, target, voxel_size=voxel_size*scale, max_it=max_it, trans_init=transform)
+        transform = result.transformation
+    return transform
+
+
+def icp_torch_coarse_to_fine(source_clouds, target_cloud, voxel_size, scales, max_it=2000):
+    """As icp_coarse_to_fine but all sources solved together by the batched torch icp on their device"""
+    transforms = None
+    for scale in scales:
+        size = voxel_size*scale
+        target = voxel_downsample(target_cloud[:, :3], size)
+        sources = [voxel_downsample(x[:, :3], size) for x in source_clouds]
+        transforms, _, _ = batched_icp(pad_sequence(sources, batch_first=True), torch.tensor([len(x) for x in sources], device=target.device),
+                                       target.unsqueeze(0), torch.tensor([len(target)], device=target.device), estimate_normals(target).unsqueeze(0),
+                                       threshold=size*0.4, max_it=max_it, init=transforms)
+    return list(transforms.cpu().numpy())
+
+
 def downsample_transform(cloud, voxel_size, transform):
-    device = cloud.device
-    source = o3d.geometry.PointCloud()
-    cloud = cloud.cpu().numpy()
-    source.points = o3d.utility.Vector3dVector(cloud[:, :3])
-    source.colors = o3d.utility.Vector3dVector(cloud[:, 3:])
-    source = source.voxel_down_sample(voxel_size)
-    source.transform(transform)
-    cloud = torch.from_numpy(np.concatenate(
-        (np.asarray(source.points), np.asarray(source.colors)), axis=-1))
-    return cloud.to(device)
+    return transform_cloud(voxel_downsample(cloud, voxel_size), transform)
 
 
 
 
 def registration_pipeline(cloud_list,voxel_size_registration,
-    voxel_size_final):
+    voxel_size_final,cache_dir=None,n_threads=None,scales=(4,2,1),backend='open3d'):
     '''Takes each entry in cloud_list which is a list of clouds
     , registers each cloud to the first entry and then returns
-     downsampled versions'''
+     downsampled versions. Sources are registered concurrently, coarse to fine (voxel_size_registration*scales), and
+     transforms are cached in cache_dir keyed by the content of target, source and the registration parameters.
+     backend is open3d (threaded) or torch (batched icp of all sources)'''
     
     
-    device = cloud_list[0].device
     # Apply registration between each cloud and first in list, store transforms
     # First cloud does not need to be transformed
     registration_transforms = [np.eye(4, dtype=np.float32)]
@@ -62,20 +124,35 @@ def registration_pipeline(cloud_list,voxel_size_registration,
     common_center  =  cloud_list[0].mean(axis=0)
     common_center[3:] =0.0
     cloud_list_ = [x - common_center for x in cloud_list]
-    target_cloud = cloud_list_[0].cpu().numpy()
-    target = o3d.geometry.PointCloud()
-    target.points = o3d.utility.Vector3dVector(target_cloud[:, :3])
-    target.colors = o3d.utility.Vector3dVector(target_cloud[:, 3:])
-    target = target.voxel_down_sample(voxel_size_registration)
-    target.estimate_normals()
-    for source_cloud in cloud_list[1:]:
-                    result = icp_reg_precomputed_target(
-                        source_cloud, target, voxel_size=voxel_size_registration)
-                    registration_transforms.append(result.transformation)
+    params = f'{voxel_size_registration}_{tuple(scales)}_{backend}'
+    target_digest = cloud_digest(cloud_list_[0])
+    cache_paths = [None] * len(cloud_list)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_paths = [os.path.join(cache_dir, hashlib.blake2b(f'{target_digest}_{cloud_digest(x)}_{params}'.encode(),
+                       digest_size=16).hexdigest() + '.npy') for x in cloud_list]
+    transforms = {index: np.load(cache_paths[index]) for index in range(1, len(cloud_list))
+                  if cache_paths[index] is not None and os.path.isfile(cache_paths[index])}
+    todo = [index for index in range(1, len(cloud_list)) if index not in transforms]
+    results = []
+    if len(todo) > 0 and backend == 'torch':
+        results = icp_torch_coarse_to_fine([cloud_list[index] for index in todo], cloud_list_[0], voxel_size_registration, scales)
+    elif len(todo) > 0 and backend == 'open3d':
+        target_pyramid = [downsample_with_normals(cloud_list_[0], voxel_size_registration*scale) for scale in scales]
+        # Open3D releases the GIL during icp, threads share the target pyramid
+        n_threads = len(todo) if n_threads is None else n_threads
+        with ThreadPoolExecutor(max_workers=max(n_threads, 1)) as executor:
+            results = list(executor.map(lambda index: icp_coarse_to_fine(
+                cloud_list[index], target_pyramid, voxel_size_registration, scales), todo))
+    elif len(todo) > 0:
+        raise Exception(f'Invalid registration backend {backend}')
+    for index, transform in zip(todo, results):
+        transforms[index] = transform
+        if cache_paths[index] is not None:
+            np.save(cache_paths[index] + '.tmp.npy', transform)
+            os.replace(cache_paths[index] + '.tmp.npy', cache_paths[index])
+    registration_transforms.extend([transforms[index] for index in range(1, len(cloud_list))])
     # Downsample and apply registration
     cloud_list = [downsample_transform(x, voxel_size_final, transform) for x, transform in zip(
                     cloud_list, registration_transforms)]
-
-    cloud_list = [x.to(device) for x in cloud_list]
     return cloud_list
-
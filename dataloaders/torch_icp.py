@@ -0,0 +1,138 @@
+import time
+import math
+import torch
+from knn import fit_knn
+
+
+def estimate_normals(points, n_neighbors=30):
+    """Unoriented normals of (n,3) points from the covariance of their nearest neighbours (as Open3D estimate_normals)"""
+    index = torch.as_tensor(fit_knn(points, min(n_neighbors, points.shape[0]))(points), device=points.device).long()
+    neighbours = points[index]
+    centered = neighbours - neighbours.mean(dim=1, keepdim=True)
+    covariance = centered.transpose(1, 2) @ centered
+    # Eigenvector of smallest eigenvalue
+    return torch.linalg.eigh(covariance.double())[1][..., 0].to(points.dtype)
+
+
+def se3_exp(xi):
+    """4x4 transforms of (b,6) rotation (axis angle) and translation updates"""
+    b = xi.shape[0]
+    skew = torch.zeros((b, 3, 3), dtype=xi.dtype, device=xi.device)
+    skew[:, 0, 1], skew[:, 0, 2], skew[:, 1, 2] = -xi[:, 2], xi[:, 1], -xi[:, 0]
+    skew = skew - skew.transpose(1, 2)
+    transform = torch.eye(4, dtype=xi.dtype, device=xi.device).repeat(b, 1, 1)
+    transform[:, :3, :3] = torch.matrix_exp(skew)
+    transform[:, :3, 3] = xi[:, 3:]
+    return transform
+
+
+def batched_icp(sources, source_lengths, targets, target_lengths, target_normals, threshold, max_it=30, init=None,
+                relative_fitness=1e-6, relative_rmse=1e-6):
+    """Point to plane icp of b padded source clouds (b,n,3) to padded targets (b or 1,m,3) with normals, all pairs solved
+    together each iteration. A single target is shared by all sources. Pairs stop updating once fitness and inlier rmse
+    change less than relative_fitness/relative_rmse (as Open3D). Returns transforms (b,4,4), fitness and rmse (b)"""
+    b, n, _ = sources.shape
+    device = sources.device
+    transforms = torch.eye(4, dtype=torch.float64, device=device).repeat(b, 1, 1) if init is None else init.clone().double()
+    valid = torch.arange(n, device=device).unsqueeze(0) < source_lengths.unsqueeze(1)
+    shared = targets.shape[0] == 1
+    target_inds = [0] * b if shared else list(range(b))
+    # Correspondence search structures are built once per target
+    knns = {ind: fit_knn(targets[ind, :target_lengths[ind]], 1, n_samples=n) for ind in set(target_inds)}
+    active = torch.ones(b, dtype=torch.bool, device=device)
+    fitness = torch.zeros(b, dtype=torch.float64, device=device)
+    rmse = torch.zeros(b, dtype=torch.float64, device=device)
+    for _ in range(max_it):
+        moved = (torch.bmm(sources.double(), transforms[:, :3, :3].transpose(1, 2)) + transforms[:, None, :3, 3]).to(sources.dtype)
+        nearest = torch.zeros((b, n), dtype=torch.long, device=device)
+        for ind in range(b):
+            if active[ind]:
+                nearest[ind, :source_lengths[ind]] = torch.as_tensor(
+                    knns[target_inds[ind]](moved[ind, :source_lengths[ind]]), device=device).long()[:, 0]
+        batch_inds = torch.tensor(target_inds, device=device).unsqueeze(1)
+        matched, normals = targets[batch_inds, nearest].double(), target_normals[batch_inds, nearest].double()
+        diff = moved.double() - matched
+        dist = torch.linalg.norm(diff, dim=-1)
+        inlier = valid & (dist < threshold)
+        n_inliers = inlier.sum(dim=1)
+
+        residual = (diff * normals).sum(dim=-1) * inlier
+        jacobian = torch.cat((torch.cross(moved.double(), normals, dim=-1), normals), dim=-1) * inlier.unsqueeze(-1)
+        hessian = jacobian.transpose(1, 2) @ jacobian + 1e-9 * torch.eye(6, dtype=torch.float64, device=device)
+        gradient = (jacobian * residual.unsqueeze(-1)).sum(dim=1)
+        xi = torch.linalg.solve(hessian, -gradient) * (active & (n_inliers >= 6)).unsqueeze(-1)
+        transforms = se3_exp(xi) @ transforms
+
+        new_fitness = n_inliers / source_lengths.clamp_min(1)
+        new_rmse = torch.sqrt((dist**2 * inlier).sum(dim=1) / n_inliers.clamp_min(1))
+        converged = ((new_fitness - fitness).abs() < relative_fitness) & ((new_rmse - rmse).abs() < relative_rmse)
+        fitness = torch.where(active, new_fitness, fitness)
+        rmse = torch.where(active, new_rmse, rmse)
+        active = active & ~converged & (n_inliers >= 6)
+        if not active.any():
+            break
+    return transforms, fitness, rmse
+
+
+if __name__ == '__main__':
+    # Benchmark against Open3D icp on synthetic pairs with known misalignment: accuracy and pairs/second
+    from torch.nn.utils.rnn import pad_sequence
+    from dataloaders.dataset_utils import downsample_with_normals, icp_reg_precomputed_target, voxel_downsample
+    torch.manual_seed(0)
+    n_pairs, voxel_size = 16, 0.05
+
+    def synthetic_scene(n_points=60000):
+        """Ground with bumps, two walls and a box, points in 10x10m"""
+        xy = torch.rand(n_points, 2) * 10
+        ground = torch.cat((xy, (0.3 * torch.sin(xy[:, :1]) * torch.cos(xy[:, 1:])) ), dim=-1)
+        wall = torch.stack((torch.full((n_points//4,), 8.), torch.rand(n_points//4) * 10, torch.rand(n_points//4) * 3), dim=-1)
+        wall_2 = torch.stack((torch.rand(n_points//4) * 10, torch.full((n_points//4,), 9.), torch.rand(n_points//4) * 3), dim=-1)
+        box = torch.rand(n_points//4, 3) * torch.tensor([1., 1., 1.5]) + torch.tensor([3., 4., 0.])
+        xyz = torch.cat((ground, wall, wall_2, box)) + torch.randn(n_points + 3*(n_points//4), 3) * 0.005
+        return torch.cat((xyz, torch.rand(xyz.shape[0], 3)), dim=-1)
+
+    targets, sources, truths = [], [], []
+    for _ in range(n_pairs):
+        target = synthetic_scene()
+        angle = (torch.rand(1).item() - 0.5) * math.radians(4)
+        truth = torch.eye(4, dtype=torch.float64)
+        truth[:2, :2] = torch.tensor([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]])
+        truth[:3, 3] = (torch.rand(3, dtype=torch.float64) - 0.5) * 0.1
+        source = target.clone()
+        # Source is target moved by inverse of truth, so truth registers source to target
+        source[:, :3] = ((source[:, :3].double() - truth[:3, 3]) @ truth[:3, :3]).float()
+        targets.append(target), sources.append(source), truths.append(truth)
+
+    def errors(transforms):
+        rotation = [math.degrees(math.acos(min(1., max(-1., ((torch.trace(t[:3, :3].T @ g[:3, :3]) - 1) / 2).item()))))
+                    for t, g in zip(transforms, truths)]
+        translation = [torch.linalg.norm(t[:3, 3] - g[:3, 3]).item() for t, g in zip(transforms, truths)]
+        return sum(rotation) / len(rotation), sum(translation) / len(translation)
+
+    for scales in [(1,), (4, 2, 1)]:
+        start = time.time()
+        o3d_transforms = []
+        for source, target in zip(sources, targets):
+            transform = None
+            for scale in scales:
+                result = icp_reg_precomputed_target(source, downsample_with_normals(target, voxel_size*scale),
+                                                    voxel_size=voxel_size*scale, trans_init=transform)
+                transform = result.transformation
+            o3d_transforms.append(torch.from_numpy(transform))
+        elapsed_o3d = time.time() - start
+
+        start = time.time()
+        transforms = None
+        for scale in scales:
+            size = voxel_size*scale
+            source_down = [voxel_downsample(x[:, :3], size) for x in sources]
+            target_down = [voxel_downsample(x[:, :3], size) for x in targets]
+            transforms, _, _ = batched_icp(pad_sequence(source_down, batch_first=True), torch.tensor([len(x) for x in source_down]),
+                                           pad_sequence(target_down, batch_first=True), torch.tensor([len(x) for x in target_down]),
+                                           pad_sequence([estimate_normals(x) for x in target_down], batch_first=True),
+                                           threshold=size*0.4, max_it=2000 if scale == 1 else 100, init=transforms)
+        elapsed_torch = time.time() - start
+
+        for name, result, elapsed in [('open3d', o3d_transforms, elapsed_o3d), ('torch', list(transforms), elapsed_torch)]:
+            rotation_error, translation_error = errors(result)
+            print(f'scales {scales} {name:>7}: {n_pairs/elapsed:.2f} pairs/s, mean rotation error {rotation_error:.4f} deg, mean translation error {translation_error:.4f} m')
@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import inspect
+import hashlib
+import contextlib
+import einops
+import torch
+from torch import nn
+import models
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class ScoringGraph(nn.Module):
+    """input_embedder and Flow.log_prob as one module (what inner_loop computes) for tracing/compiling/exporting"""
+
+    def __init__(self, input_embedder, flow, global_embedding=False):
+        super().__init__()
+        self.input_embedder = input_embedder
+        self.flow = flow
+        self.global_embedding = global_embedding
+
+    def forward(self, extract_0, extract_1, extra_context=None):
+        input_embeddings = self.input_embedder(extract_0)
+        if self.global_embedding:
+            input_embeddings = input_embeddings.unsqueeze(1)
+        return self.flow.log_prob(extract_1, context=input_embeddings, extra_context=extra_context)
+
+
+def checkpoint_key(load_path):
+    """Short id of a checkpoint file from its path, size and modification time"""
+    stat = os.stat(load_path)
+    return hashlib.blake2b(f'{os.path.abspath(load_path)}_{stat.st_size}_{stat.st_mtime_ns}'.encode(), digest_size=8).hexdigest()
+
+
+def example_inputs(config, shapes, device):
+    """Random extract_0, extract_1 (and repeated extra_context if used) of shapes (batch_size, sample_size, n_samples_context)"""
+    batch_size, sample_size, n_samples_context = shapes
+    inputs = (torch.randn((batch_size, n_samples_context, config['input_dim']), device=device),
+              torch.randn((batch_size, sample_size, config['input_dim']), device=device))
+    if config['using_extra_context']:
+        inputs = inputs + (torch.randn((batch_size, sample_size, config['extra_context_dim']), device=device),)
+    return inputs
+
+
+class StaticScorer:
+    """Log likelihoods as inner_loop, with the model traced (TorchScript, backend 'trace') or compiled (backend 'compile')
+    for fixed (batch_size, sample_size, n_samples_context). Traced modules are saved in cache_dir keyed by checkpoint and
+    shape, compiled kernels go to the inductor cache in cache_dir. Batches of other shapes run eager"""
+
+    def __init__(self, models_dict, config, batch_size, backend='trace', cache_dir='save/compiled', key=None, optimize=True):
+        if backend not in ['trace', 'compile']:
+            raise Exception(f'Invalid backend: {backend}')
+        flow = getattr(models_dict['flow'], 'module', models_dict['flow'])
+        input_embedder = getattr(models_dict['input_embedder'], 'module', models_dict['input_embedder'])
+        flow = models.optimize_for_inference(flow) if optimize else flow.eval()
+        self.graph = ScoringGraph(input_embedder.eval(), flow, config['global']).eval()
+        self.config = config
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.key = key
+        self.shapes = (batch_size, config['sample_size'], config['n_samples_context'])
+        self.device = next(self.graph.parameters()).device
+        self.compiled = None
+        os.makedirs(cache_dir, exist_ok=True)
+        if backend == 'compile':
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+
+    def artifact_path(self):
+        if self.key is None:
+            return None
+        shape = 'x'.join(str(x) for x in self.shapes)
+        return os.path.join(self.cache_dir, f'{self.key}_{shape}_{self.device.type}_{self.config["using_extra_context"]}.pt')
+
+    def build(self):
+        if self.backend == 'compile' and not hasattr(torch, 'compile'):
+            print('torch.compile not available, running eager')
+            self.compiled = self.graph
+            return
+        if self.backend == 'compile':
+            from torch._inductor import config as inductor_config
+            # Same random numbers (augmenter noise) as eager
+            inductor_config.fallback_random = True
+            self.compiled = torch.compile(self.graph, dynamic=False)
+            return
+        path = self.artifact_path()
+        if path is not None and os.path.isfile(path):
+            self.compiled = torch.jit.load(path, map_location=self.device)
+            return
+        # Tracing runs the model once, which should not shift the random state of the caller
+        with torch.no_grad(), torch.random.fork_rng(devices=[self.device] if self.device.type == 'cuda' else []):
+            # Sampling in the augmenters makes outputs differ between runs, so no trace check
+            self.compiled = torch.jit.freeze(torch.jit.trace(self.graph, example_inputs(self.config, self.shapes, self.device), check_trace=False))
+        if path is not None:
+            torch.jit.save(self.compiled, path)
+
+    def static_shape(self, extract_0, extract_1):
+        return (extract_1.shape[0], extract_1.shape[1], extract_0.shape[1]) == self.shapes
+
+    def __call__(self, extract_0, extract_1, extra_context=None):
+        """Log likelihood of extract_1 given extract_0 (b,n), extra_context (b,c) as in inner_loop"""
+        if extra_context is not None:
+            extra_context = einops.repeat(extra_context, 'b c-> b n c', n=extract_1.shape[1])
+        inputs = (extract_0, extract_1) + ((extra_context,) if extra_context is not None else ())
+        with torch.no_grad():
+            if not self.static_shape(extract_0, extract_1):
+                return self.graph(*inputs)
+            if self.compiled is None:
+                self.build()
+            return self.compiled(*inputs)
+
+
+def noise_sources(flow):
+    """Distributions the augmenters of flow sample from"""
+    return [module.noise_dist for module in flow.modules() if isinstance(module, models.Augment)]
+
+
+@contextlib.contextmanager
+def fixed_noise(flow, noise):
+    """Augmenters of flow use the given standard normal noise (one (b,n,c) tensor per augmenter) instead of sampling"""
+    sources = noise_sources(flow)
+    if len(noise) != len(sources):
+        raise Exception(f'Expected {len(sources)} noise tensors, got {len(noise)}')
+    for source, source_noise in zip(sources, noise):
+        source.noise = source_noise
+    try:
+        yield
+    finally:
+        for source in sources:
+            source.noise = None
+
+
+class NoiseInputGraph(nn.Module):
+    """ScoringGraph with the augmenter noise as inputs (after extract_0, extract_1 and extra_context), so an exported
+    graph holds no random ops"""
+
+    def __init__(self, graph):
+        super().__init__()
+        self.graph = graph
+        self.n_noise = len(noise_sources(graph.flow))
+
+    def forward(self, extract_0, extract_1, *args):
+        extra_context, noise = (None, args) if len(args) == self.n_noise else (args[0], args[1:])
+        with fixed_noise(self.graph.flow, noise):
+            return self.graph(extract_0, extract_1, extra_context)
+
+
+def noise_dim(source):
+    """Width of the noise an augmenter distribution samples"""
+    if isinstance(source, models.StandardNormal):
+        return source.shape[-1]
+    return source.net.out_dim // 2
+
+
+def export_onnx(models_dict, config, path, batch_size=1, opset=13, optimize=True):
+    """Export input_embedder and Flow.log_prob (as inner_loop) to ONNX at path, with batch size as dynamic axis and the
+    augmenter noise as inputs. Meta data needed by OnnxScorer is written next to it as json. Opset 13 is the highest
+    torch 1.8 exports"""
+    flow = getattr(models_dict['flow'], 'module', models_dict['flow'])
+    input_embedder = getattr(models_dict['input_embedder'], 'module', models_dict['input_embedder'])
+    flow = models.optimize_for_inference(flow) if optimize else flow.eval()
+    # Export restores the train/eval mode of graph afterwards, which would apply to the shared input_embedder and flow modules
+    graph = NoiseInputGraph(ScoringGraph(input_embedder.eval(), flow, config['global'])).eval()
+    device = next(graph.parameters()).device
+    noise_dims = [noise_dim(x) for x in noise_sources(flow)]
+    inputs = example_inputs(config, (batch_size, config['sample_size'], config['n_samples_context']), device)
+    inputs = inputs + tuple(torch.randn((batch_size, config['sample_size'], dim), device=device) for dim in noise_dims)
+    names = ['extract_0', 'extract_1'] + (['extra_context'] if config['using_extra_context'] else []) + [f'noise_{i}' for i in range(len(noise_dims))]
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(graph, inputs, path, input_names=names, output_names=['log_prob'], opset_version=opset,
+                          dynamic_axes={name: {0: 'batch'} for name in names + ['log_prob']}, **kwargs)
+    meta = {'input_names': names, 'noise_dims': noise_dims, 'sample_size': config['sample_size'],
+            'n_samples_context': config['n_samples_context'], 'using_extra_context': config['using_extra_context']}
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def compare_onnx(load_path, path, batch_size=1, intra_op_threads=None, n_repeats=10, atol=1e-3, check_sample_sizes=(64, 1500)):
+    """Export the checkpoint at load_path to ONNX at path and compare OnnxScorer to eager inner_loop (on cpu) on random
+    inputs with the same augmenter noise: max log likelihood difference, startup (eager: initialize_flow and load_flow,
+    ONNX: creating the session) and per voxel time of both. The difference is also checked for exports with each of
+    check_sample_sizes points (sample sizes that are not a multiple of the attention chunk size)"""
+    from onnx_scorer import OnnxScorer
+    from train import initialize_flow, load_flow, inner_loop
+    start = time.time()
+    save_dict = torch.load(load_path, map_location='cpu')
+    config = save_dict['config']
+    models_dict = load_flow(save_dict, initialize_flow(config, 'cpu', mode='test'))
+    models_dict['input_embedder'].eval(), models_dict['flow'].eval()
+    eager_startup = time.time() - start
+    flow = getattr(models_dict['flow'], 'module', models_dict['flow'])
+    result = {'max_diff': 0.}
+    for sample_size in [config['sample_size']] + [x for x in check_sample_sizes if x != config['sample_size']]:
+        timed = sample_size == config['sample_size']
+        sample_config = dict(config, sample_size=sample_size)
+        sample_path = path if timed else f'{os.path.splitext(path)[0]}_{sample_size}{os.path.splitext(path)[1]}'
+        meta = export_onnx(models_dict, sample_config, sample_path, batch_size)
+        start = time.time()
+        scorer = OnnxScorer(sample_path, intra_op_threads=intra_op_threads)
+        onnx_startup = time.time() - start
+        inputs = example_inputs(sample_config, (batch_size, sample_size, config['n_samples_context']), 'cpu')
+        extra_context = inputs[2][:, 0] if len(inputs) > 2 else None
+        noise = [torch.randn((batch_size, sample_size, dim)) for dim in meta['noise_dims']]
+        batch = [inputs[0], inputs[1], extra_context]
+        numpy_inputs = [x.numpy() for x in inputs[:2]] + [None if extra_context is None else extra_context.numpy()]
+        numpy_noise = [x.numpy() for x in noise]
+        with torch.no_grad(), fixed_noise(flow, noise):
+            eager = inner_loop(batch, models_dict, sample_config)[1]
+            if timed:
+                start = time.time()
+                for _ in range(n_repeats):
+                    inner_loop(batch, models_dict, sample_config)
+                eager_time = (time.time() - start) / n_repeats
+        onnx = scorer(*numpy_inputs, noise=numpy_noise)
+        if timed:
+            start = time.time()
+            for _ in range(n_repeats):
+                scorer(*numpy_inputs, noise=numpy_noise)
+            onnx_time = (time.time() - start) / n_repeats
+            result.update({'eager_startup': eager_startup, 'onnx_startup': onnx_startup,
+                           'eager_voxel_time': eager_time / batch_size, 'onnx_voxel_time': onnx_time / batch_size})
+        max_diff = (eager - torch.from_numpy(onnx)).abs().max().item()
+        if max_diff > atol:
+            print(f'Warning: ONNX log likelihoods with sample_size {sample_size} differ from eager by {max_diff}')
+        result['max_diff'] = max(result['max_diff'], max_diff)
+    return result
+
+if __name__ == '__main__':
+    # Benchmark eager vs traced/compiled (and ONNX Runtime on cpu) scoring for every flow_type and permuter_type on random weights
+    from utils import config_loader
+    from train import initialize_flow
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    batch_size, n_repeats = 1, 10
+    config_base = config_loader('config/config.yaml')
+    config_base['data_parallel'] = False
+    for flow_type in ['AffineCoupling', 'ExponentialCoupling', 'RationalQuadraticSplineCoupling']:
+        for permuter_type in ['LinearLU', 'FullCombiner', 'ExponentialCombiner', 'random_permute']:
+            config = dict(config_base, flow_type=flow_type, permuter_type=permuter_type)
+            models_dict = initialize_flow(config, device, mode='test')
+            shapes = (batch_size, config['sample_size'], config['n_samples_context'])
+            inputs = example_inputs(config, shapes, device)
+            extra_context = inputs[2][:, 0] if len(inputs) > 2 else None
+            # All backends run the same folded flow so speedups are from tracing/compiling only
+            optimized_dict = dict(models_dict, flow=models.optimize_for_inference(models_dict['flow']))
+            eager = ScoringGraph(models_dict['input_embedder'].eval(), optimized_dict['flow'], config['global']).eval()
+            timings = {}
+            for name in ['eager', 'trace'] + (['compile'] if hasattr(torch, 'compile') else []):
+                scorer = None if name == 'eager' else StaticScorer(optimized_dict, config, batch_size, backend=name, optimize=False)
+                run = (lambda: eager(inputs[0], inputs[1], None if extra_context is None else
+                                     einops.repeat(extra_context, 'b c-> b n c', n=config['sample_size']))) if name == 'eager' else (
+                    lambda: scorer(inputs[0], inputs[1], extra_context))
+                with torch.no_grad():
+                    start = time.time()
+                    run()
+                    first = time.time() - start
+                    if device.type == 'cuda':
+                        torch.cuda.synchronize()
+                    start = time.time()
+                    for _ in range(n_repeats):
+                        run()
+                    if device.type == 'cuda':
+                        torch.cuda.synchronize()
+                timings[name] = ((time.time() - start) / n_repeats, first)
+            eager_time = timings['eager'][0]
+            print(f'{flow_type:>31} {permuter_type:>19}: ' + ', '.join(
+                f'{name} {elapsed*1000:.1f} ms (first call {first:.1f} s, x{eager_time/elapsed:.2f})' for name, (elapsed, first) in timings.items()))
+            if onnxruntime is not None:
+                try:
+                    # Random weights saved as checkpoint so eager startup includes loading
+                    load_path = os.path.join('save', 'compiled', f'{flow_type}_{permuter_type}_random.pt')
+                    torch.save({'config': config, 'input_embedder': models_dict['input_embedder'].state_dict(),
+                                'flow': models_dict['flow'].state_dict()}, load_path)
+                    result = compare_onnx(load_path, os.path.join('save', 'compiled', f'{flow_type}_{permuter_type}.onnx'), batch_size)
+                    print(f'{"":>51} cpu eager {result["eager_voxel_time"]*1000:.1f} ms/voxel (startup {result["eager_startup"]:.1f} s), '
+                          f'onnx {result["onnx_voxel_time"]*1000:.1f} ms/voxel (startup {result["onnx_startup"]:.1f} s, '
+                          f'x{result["eager_voxel_time"]/result["onnx_voxel_time"]:.2f}), max log likelihood difference {result["max_diff"]:.2e}')
+                except Exception as e:
+                    print(f'{"":>51} onnx export failed: {e}')
@@ -1,9 +1,20 @@
 
 import time
+import itertools
 import torch
-from pykeops.torch import Vi, Vj
+from scipy.spatial import cKDTree
+try:
+    from pykeops.torch import Vi, Vj
+except ImportError:
+    # KeOps needs a compiler and is missing on cpu only nodes
+    Vi = Vj = None
+
+# Bytes the distance matrix of a single brute force query may take
+DEFAULT_MEMORY_BUDGET = 2**28
 
 def KNN_KeOps(K, metric="euclidean"):
+    if Vi is None:
+        raise Exception('KeOps not available')
     def fit(x_train):
         # Setup the K-NN estimator:
         
@@ -76,42 +87,118 @@ def KNN_torch(K):
 
     return fit
 
-def get_knn(samples,context_cloud,n_neighbors,type='torch'):
+def KNN_tiled(K, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Brute force as KNN_torch but streaming over blocks of queries and references, keeping a running top K, so the
+    distance block never exceeds memory_budget bytes"""
+    def fit(x_train):
+        start = time.time()
+        x_train_norm = (x_train ** 2).sum(-1)
+        elapsed = time.time() - start
+
+        def f(x_test):
+            start = time.time()
+            n_train = x_train.shape[0]
+            element_size = x_test.element_size()
+            # Reference blocks at least K long so a block alone can fill the running top K
+            train_block = max(min(n_train, memory_budget // (element_size * 1024)), min(K, n_train))
+            test_block = max(memory_budget // (element_size * train_block), 1)
+            indices = []
+            for test_start in range(0, x_test.shape[0], test_block):
+                x_block = x_test[test_start:test_start+test_block]
+                best_dists, best_indices = None, None
+                for train_start in range(0, n_train, train_block):
+                    train_end = min(train_start+train_block, n_train)
+                    diss = ((x_block ** 2).sum(-1).view(-1, 1) + x_train_norm[train_start:train_end].view(1, -1)
+                            - 2 * x_block @ x_train[train_start:train_end].t())
+                    if best_dists is not None:
+                        diss = torch.cat((best_dists, diss), dim=1)
+                    top = diss.topk(min(K, diss.shape[1]), dim=1, largest=False)
+                    block_indices = torch.arange(train_start, train_end, device=x_test.device)
+                    candidates = block_indices.expand(x_block.shape[0], -1) if best_indices is None else torch.cat(
+                        (best_indices, block_indices.expand(x_block.shape[0], -1)), dim=1)
+                    best_dists, best_indices = top.values, candidates.gather(1, top.indices)
+                indices.append(best_indices)
+            elapsed = time.time() - start
+            return torch.cat(indices), elapsed
+        return f, elapsed
+
+    return fit
+
+
+def KNN_tree(K):
+    """KD-tree (scipy) on cpu, for low dimensional (xyz) clouds"""
+    def fit(x_train):
+        start = time.time()
+        tree = cKDTree(x_train.detach().cpu().numpy())
+        elapsed = time.time() - start
+
+        def f(x_test):
+            start = time.time()
+            _, indices = tree.query(x_test.detach().cpu().numpy(), k=K, workers=-1)
+            indices = torch.from_numpy(indices).long().reshape(x_test.shape[0], K).to(x_test.device)
+            elapsed = time.time() - start
+            return indices, elapsed
+        return f, elapsed
+
+    return fit
+
+
+def knn_backend(n_test, n_train, dim, K, device='cpu', memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Pick knn backend from problem size, dimension and device"""
+    if torch.device(device).type == 'cpu' and dim <= 4 and K <= 64:
+        return 'tree'
+    if n_test * n_train * 4 <= memory_budget:
+        return 'torch'
+    if Vi is not None and torch.device(device).type == 'cuda':
+        return 'KeOps'
+    return 'tiled'
+
+
+def fit_knn(context_cloud,n_neighbors,n_samples=None,type='auto',memory_budget=DEFAULT_MEMORY_BUDGET):
+        """Fit knn backend on context_cloud once, returns query function of samples giving neighbour indices.
+        n_samples (expected number of queries) is only used to pick the backend"""
+        if type == 'auto':
+            n_samples = context_cloud.shape[0] if n_samples is None else n_samples
+            type = knn_backend(n_samples,context_cloud.shape[0],context_cloud.shape[1],n_neighbors,
+                               device=context_cloud.device,memory_budget=memory_budget)
         if type == 'torch':
             knn_func = KNN_torch
         elif type == 'KeOps':
             knn_func = KNN_KeOps
+        elif type == 'tiled':
+            knn_func = lambda K: KNN_tiled(K,memory_budget=memory_budget)
+        elif type == 'tree':
+            knn_func = KNN_tree
         else:
             raise Exception('Invalid knn func')
         knn =  knn_func(n_neighbors)
         knn,_ = knn(context_cloud)
-        index,_  = knn(samples)
+        return lambda samples: knn(samples)[0]
+
+def get_knn(samples,context_cloud,n_neighbors,type='auto',memory_budget=DEFAULT_MEMORY_BUDGET):
+        knn = fit_knn(context_cloud,n_neighbors,n_samples=samples.shape[0],type=type,memory_budget=memory_budget)
+        index = knn(samples)
         
         return index
 if __name__ == '__main__':
-    use_cuda = True
-    dtype = torch.cuda.FloatTensor if use_cuda else torch.FloatTensor
-
-
-
-
-
-    device = 'cpu'
-    context_cloud = torch.randn((100000,3)).to(device).contiguous()
-    context = context_cloud[:,:3].contiguous()
-    x = torch.randn((1000,3)).to(device).contiguous()
-    k=1000
-
-
-    for knn_func in [KNN_torch,KNN_KeOps]:
-        print(str(knn_func))
-        knn = knn_func(k)
-        fitted_knn,elapsed_fit = knn(context)
-        print(f'Fitting: {elapsed_fit}')
-        index,elapsed_query = fitted_knn(x)
-        print(f'Query: {elapsed_query}')
-        elapsed_total = elapsed_fit+elapsed_query
-        print(f'Total: {elapsed_total}')
-        context_cloud = context_cloud.cpu()
-        index = index.cpu()
+    # Benchmark all backends over number of queries (N), references (M) and neighbours (K)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    dim = 3
+    backends = {'torch': KNN_torch, 'tiled': KNN_tiled, 'tree': KNN_tree}
+    if Vi is not None:
+        backends['KeOps'] = KNN_KeOps
+
+    print(f'Device: {device}, dim: {dim}')
+    print(f"{'N':>8} {'M':>8} {'K':>5} {'backend':>8} {'fit':>8} {'query':>8} {'auto':>6}")
+    for n_test, n_train, k in itertools.product([1000, 10000, 100000], [10000, 100000, 1000000], [1, 16, 256]):
+        context = torch.randn((n_train, dim)).to(device).contiguous()
+        x = torch.randn((n_test, dim)).to(device).contiguous()
+        auto = knn_backend(n_test, n_train, dim, k, device=device)
+        for name, knn_func in backends.items():
+            if name == 'torch' and n_test * n_train * 4 > 8 * DEFAULT_MEMORY_BUDGET:
+                # Full distance matrix would not fit
+                continue
+            fitted_knn, elapsed_fit = knn_func(k)(context)
+            _, elapsed_query = fitted_knn(x)
+            print(f"{n_test:>8} {n_train:>8} {k:>5} {name:>8} {elapsed_fit:>8.3f} {elapsed_query:>8.3f} {'*' if name == auto else '':>6}")
 
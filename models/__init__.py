@@ -1,6 +1,6 @@
 from .nets import MLP
 from .permuters import  ExponentialCombiner, Permuter,FullCombiner,Reverse,LinearLU
-from .perceiver import get_cross_attn
+from .perceiver import get_cross_attn, PrecomputedKV, attention_layers
 from .pytorch_gcn import DGCNNembedder,DGCNNembedderGlobal
 from .transform import Transform, Flow, PreConditionApplier, IdentityTransform
 from .augmenter import Augment, AugmentAttentionPreconditioner
@@ -11,4 +11,6 @@ from .act_norm import ActNormBijectionCloud
 from .cif_block import CIFblock,cif_helper
 from .affine_coupling import AffineCoupling
 from .spline_coupling import RationalQuadraticSplineCoupling
+from .inference import optimize_for_inference, check_log_prob, LinearBijection
+from .checkpointing import CheckpointPolicy
 from .scene_seg_PAConv import PointNet2SSGSeg
\ No newline at end of file
@@ -3,13 +3,18 @@ import torch
 from torch import nn
 from models.nets import MLP
 from models import Transform
+from models.checkpointing import checkpoint
 
 
 class AffineCoupling(Transform):
-    def __init__(self, input_dim, hidden_dims, nonlinearity, context_dim=0, event_dim=-1, scale_fn_type='exp', eps=1E-8,split_dim=None):
-        """Implements affine coupling transform according to https://arxiv.org/abs/1605.08803 with choice between exponential and sigmoid scaling"""
+    checkpointable = True
+
+    def __init__(self, input_dim, hidden_dims, nonlinearity, context_dim=0, event_dim=-1, scale_fn_type='exp', eps=1E-8,split_dim=None,condition_on_last=False):
+        """Implements affine coupling transform according to https://arxiv.org/abs/1605.08803 with choice between exponential and sigmoid scaling.
+        The first split_dim features condition the rest, or the last split_dim features the ones before if condition_on_last"""
         super().__init__()
         self.event_dim = event_dim
+        self.condition_on_last = condition_on_last
         self.input_dim = input_dim
         if split_dim ==  None:
             self.split_dim = input_dim//2
@@ -27,15 +32,25 @@ class AffineCoupling(Transform):
         else:
             raise Exception('Invalid scale_fn_type')
 
+    def split(self, x):
+        x2_size = self.input_dim - self.split_dim
+        if self.condition_on_last:
+            x2, x1 = x.split([x2_size, self.split_dim], dim=self.event_dim)
+        else:
+            x1, x2 = x.split([self.split_dim, x2_size], dim=self.event_dim)
+        return x1, x2
+
+    def merge(self, x1, x2):
+        return torch.cat([x2, x1] if self.condition_on_last else [x1, x2], dim=self.event_dim)
+
     def forward(self, x, context=None):
         x2_size = self.input_dim - self.split_dim
-        x1, x2 = x.split([self.split_dim, x2_size], dim=self.event_dim)
+        x1, x2 = self.split(x)
 
         nn_input = torch.cat(
             (x1, context), dim=self.event_dim) if self.context_dim != 0 else x1
 
-        s, t = torch.utils.checkpoint.checkpoint(
-            self.nn, nn_input, preserve_rng_state=False).split([x2_size, x2_size], dim=-1)
+        s, t = checkpoint(self, self.nn, nn_input).split([x2_size, x2_size], dim=-1)
 
         s = self.scale_fn(s)
 
@@ -43,11 +58,11 @@ class AffineCoupling(Transform):
         y2 = x2*s + t
 
         ldj = torch.einsum('bnd->bn', torch.log(s))
-        return torch.cat([y1, y2], dim=self.event_dim), ldj
+        return self.merge(y1, y2), ldj
 
     def inverse(self, y, context=None):
         y2_size = self.input_dim - self.split_dim
-        y1, y2 = y.split([self.split_dim, y2_size], dim=self.event_dim)
+        y1, y2 = self.split(y)
         x1 = y1
 
         nn_input = torch.cat(
@@ -59,4 +74,4 @@ class AffineCoupling(Transform):
 
         x2 = (y2-t)/s
 
-        return torch.cat([x1, x2], dim=self.event_dim)
+        return self.merge(x1, x2)
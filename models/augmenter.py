@@ -1,6 +1,7 @@
 import torch
 from models import Transform
 from .distributions import ConditionalDistribution
+from .perceiver import resolve_context
 
 # Code adapted from : https://github.com/didriknielsen/survae_flows/
 
@@ -13,7 +14,8 @@ class AugmentAttentionPreconditioner(Transform):
         self.pre_attn_mlp = pre_attn_mlp
 
     def forward(self,x,context,extra_context=None):
-        attention_emb = self.attn(self.pre_attn_mlp(x),context)
+        context, kv = resolve_context(context, self.attn)
+        attention_emb = self.attn(self.pre_attn_mlp(x),context,kv)
         if extra_context!=None:
             attention_emb = torch.cat((extra_context,attention_emb),dim=-1)
         return self.augment(x,attention_emb)
@@ -0,0 +1,74 @@
+import math
+import torch
+import torch.utils.checkpoint
+
+
+class CheckpointPolicy:
+    """Which flow blocks recompute their activations in backward instead of storing them.
+    mode 'none', 'every' (every k-th block) or 'auto' (fewest checkpointed blocks that fit memory_budget bytes of activations)"""
+
+    def __init__(self, mode='every', every=1, memory_budget=None):
+        if mode not in ['none', 'every', 'auto']:
+            raise Exception(f'Invalid checkpoint policy: {mode}')
+        if mode == 'auto' and memory_budget is None:
+            raise Exception('Auto checkpoint policy needs a memory budget')
+        self.mode = mode
+        self.every = every
+        self.memory_budget = memory_budget
+
+    @staticmethod
+    def from_config(config):
+        # Configs of older checkpoints lack the keys
+        return CheckpointPolicy(config.get('checkpoint_policy', 'every'), every=config.get('checkpoint_every', 1),
+                                memory_budget=config.get('checkpoint_memory_budget_gb', 8) * 2**30)
+
+    def apply(self, flow, config):
+        """Set this policy on the modules of flow, numbering its checkpointable blocks, and for 'auto' pick every so the
+        estimated activations fit the budget"""
+        blocks = [transform for transform in flow.transforms if any(getattr(x, 'checkpointable', False) for x in transform.modules())]
+        for module in flow.modules():
+            module.checkpoint_policy = self
+        for index, block in enumerate(blocks):
+            for module in block.modules():
+                module.checkpoint_block = index
+        if self.mode == 'auto':
+            self.every = fit_every(len(blocks), *block_activation_bytes(config), self.memory_budget)
+        return self
+
+    def checkpointed(self, module):
+        if self.mode == 'none' or self.every is None:
+            return False
+        return getattr(module, 'checkpoint_block', 0) % self.every == 0
+
+
+def block_activation_bytes(config):
+    """Rough bytes of activations stored by one flow block for backward, without and with checkpointing"""
+    inner_dim = config['cross_heads'] * config['cross_dim_head']
+    per_point = (2 * sum(config['hidden_dims']) + 2 * sum(config['pre_attention_mlp_hidden_dims']) + config['attn_input_dim']
+                 + 2 * inner_dim + config['attn_dim'] + config['cross_heads'] * config['n_samples_context'] + 4 * config['latent_dim'])
+    # Checkpointed blocks keep only their inputs
+    per_point_checkpointed = 2 * config['latent_dim'] + config['attn_dim']
+    n_points = config['batch_size'] * config['sample_size'] * 4
+    return per_point * n_points, per_point_checkpointed * n_points
+
+
+def fit_every(n_blocks, block_bytes, checkpointed_block_bytes, memory_budget):
+    """Largest every (None for no checkpointing) whose estimated activations fit the budget, 1 if none fits"""
+    for every in [None] + list(range(n_blocks, 0, -1)):
+        n_checkpointed = 0 if every is None else math.ceil(n_blocks / every)
+        # One checkpointed block is recomputed in full at a time during backward
+        memory = (n_blocks - n_checkpointed) * block_bytes + n_checkpointed * checkpointed_block_bytes + (block_bytes if n_checkpointed > 0 else 0)
+        if memory <= memory_budget:
+            return every
+    return 1
+
+
+# Policy of modules of flows the policy was not applied to, checkpointing everything
+default_policy = CheckpointPolicy()
+
+
+def checkpoint(module, function, *args):
+    """function(*args), checkpointed if gradients are tracked and the policy of module selects its block"""
+    if torch.is_grad_enabled() and getattr(module, 'checkpoint_policy', default_policy).checkpointed(module):
+        return torch.utils.checkpoint.checkpoint(function, *args, preserve_rng_state=False)
+    return function(*args)
@@ -1,9 +1,13 @@
 import torch
 import torch.nn as nn
 import models
+from models.perceiver import resolve_context
+from models.checkpointing import checkpoint
 
 
 class CouplingPreconditionerAttn(nn.Module):
+    checkpointable = True
+
     def __init__(self, attn, pre_attention_mlp, x1_dim, event_dim=-1):
         super().__init__()
         self.attn = attn
@@ -13,10 +17,10 @@ class CouplingPreconditionerAttn(nn.Module):
 
     def forward(self, x, context):
         x1, x2 = x.split([self.x1_dim, self.x1_dim], dim=self.event_dim)
-        mlp_out = torch.utils.checkpoint.checkpoint(
-            self.pre_attention_mlp, x1, preserve_rng_state=False)
-        attn_emb = torch.utils.checkpoint.checkpoint(
-            self.attn, mlp_out, context, preserve_rng_state=False)
+        mlp_out = checkpoint(self, self.pre_attention_mlp, x1)
+        # Precomputed kv is passed as a tensor so checkpointing tracks it
+        context, kv = resolve_context(context, self.attn)
+        attn_emb = checkpoint(self, self.attn, mlp_out, context, kv)
         return attn_emb
 
 
@@ -24,7 +28,7 @@ class CouplingPreconditionerGlobal(nn.Module):
     def __init__(self):
         super().__init__()
     def forward(self, x, context):
-        return context
+        return resolve_context(context, self)[0]
 
 
 def cif_helper(config,flow, attn,pre_attention_mlp, event_dim=-1):
@@ -46,6 +50,9 @@ def cif_helper(config,flow, attn,pre_attention_mlp, event_dim=-1):
 
 
 class CIFblock(models.Transform):
+    # Slices after augmenting, inverse only rebuilds the input given the sliced off part (see forward_sliced)
+    reconstructable = False
+
     def __init__(self, config,flow,attn,event_dim):
         super().__init__()
         self.config = config
@@ -67,7 +74,11 @@ class CIFblock(models.Transform):
         self.reverse = models.Reverse(config['cif_latent_dim'],dim=-1)
         
 
-    def forward(self, x, context=None):
+    def forward(self, x, context=None, extra_context=None):
+        return self.forward_sliced(x, context=context, extra_context=extra_context)[:2]
+
+    def forward_sliced(self, x, context=None, extra_context=None):
+        """forward, also returning the sliced off elements"""
         ldj_cif = torch.zeros(x.shape[:-1], device=x.device, dtype=x.dtype)
 
        
@@ -84,6 +95,7 @@ class CIFblock(models.Transform):
         ldj_cif += ldj
 
         x,_ = self.reverse(x)
+        sliced = self.slicer.split_input(x)[1]
         
         x, ldj = self.slicer(x, context=None)
         ldj_cif += ldj
@@ -98,11 +110,12 @@ class CIFblock(models.Transform):
         
         
 
-        return x, ldj_cif
+        return x, ldj_cif, sliced
 
-    def inverse(self, y, context=None):
+    def inverse(self, y, context=None, extra_context=None, sliced=None):
+        """Inverse, exact given the sliced off elements of forward_sliced, else with newly sampled ones"""
         y = self.flow.inverse(y,context=context)
-        y = self.slicer.inverse(y)
+        y = self.slicer.inverse(y, sliced=sliced)
         y = self.reverse.inverse(y)
         y = self.act_norm.inverse(y)
         y = self.affine_cif.inverse(y)
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import math
 from utils import sum_except_batch, mean_except_batch
+from models.checkpointing import checkpoint
 
 # Code adapted from : https://github.com/didriknielsen/survae_flows/
 
@@ -119,6 +120,9 @@ class ConditionalMeanStdNormal(ConditionalDistribution):
 
 class ConditionalNormal(ConditionalDistribution):
     """A multivariate Normal with conditional mean and log_std."""
+    checkpointable = True
+    # Standard normal noise used instead of sampling if set (e.g. noise as input of an exported graph)
+    noise = None
 
     def __init__(self, net, split_dim=-1, clamp=False):
         super().__init__()
@@ -127,8 +131,7 @@ class ConditionalNormal(ConditionalDistribution):
 
     def cond_dist(self, context):
 
-        params = torch.utils.checkpoint.checkpoint(
-            self.net, context, preserve_rng_state=False)
+        params = checkpoint(self, self.net, context)
         #params = self.net(context)
         mean, log_std = torch.chunk(params, chunks=2, dim=-1)
         scale = log_std.exp()
@@ -141,13 +144,16 @@ class ConditionalNormal(ConditionalDistribution):
         dist = self.cond_dist(context)
         return sum_except_batch(dist.log_prob(x), num_dims=2)
 
+    def rsample(self, dist):
+        return dist.rsample() if self.noise is None else dist.loc + dist.scale * self.noise
+
     def sample(self, context):
         dist = self.cond_dist(context)
-        return dist.rsample()
+        return self.rsample(dist)
 
     def sample_with_log_prob(self, context):
         dist = self.cond_dist(context)
-        z = dist.rsample()
+        z = self.rsample(dist)
         log_prob = dist.log_prob(z)
         log_prob = sum_except_batch(log_prob, num_dims=2)
         return z, log_prob
@@ -183,6 +189,8 @@ class StandardUniform(Distribution):
 
 class StandardNormal(Distribution):
     """A multivariate Normal with zero mean and unit covariance."""
+    # Returned instead of sampling if set (see ConditionalNormal)
+    noise = None
 
     def __init__(self, shape):
         super(StandardNormal, self).__init__()
@@ -195,6 +203,8 @@ class StandardNormal(Distribution):
         return sum_except_batch(log_base+log_inner, num_dims=2)
 
     def sample(self, num_samples, context=None, n_points=None):
+        if self.noise is not None:
+            return self.noise
         sample_shape = list(self.shape)
         sample_shape[-2] = n_points
         return torch.randn(num_samples, *sample_shape, device=self.buffer.device, dtype=self.buffer.dtype)
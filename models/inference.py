@@ -0,0 +1,127 @@
+import copy
+import torch
+import torch.nn.functional as F
+from models.transform import Flow, Transform, IdentityTransform
+from models.act_norm import ActNormBijectionCloud
+from models.permuters import LinearLU, FullCombiner, ExponentialCombiner, Permuter
+from models.cif_block import CIFblock
+
+
+class LinearBijection(Transform):
+    """Per point affine bijection z = W x + b with constant ldj, folded from a run of linear transforms.
+    Stored as index remapping and scale if W has one non zero per row (permutations and act norms), else dense"""
+
+    def __init__(self, weight, bias, ldj, dtype=torch.float32):
+        super().__init__()
+        nonzero = weight != 0
+        self.monomial = bool((nonzero.sum(dim=-1) == 1).all() and (nonzero.sum(dim=0) == 1).all())
+        if self.monomial:
+            permutation = nonzero.long().argmax(dim=-1)
+            self.register_buffer('permutation', permutation)
+            self.register_buffer('inv_permutation', torch.argsort(permutation))
+            self.register_buffer('scale', weight.gather(-1, permutation[:, None])[:, 0].to(dtype))
+        else:
+            self.register_buffer('weight', weight.to(dtype))
+            self.register_buffer('weight_inverse', torch.linalg.inv(weight).to(dtype))
+        self.register_buffer('bias', bias.to(dtype))
+        self.register_buffer('ldj', ldj.to(dtype))
+
+    def forward(self, x, context=None, extra_context=None):
+        if self.monomial:
+            z = torch.addcmul(self.bias, x.index_select(-1, self.permutation), self.scale)
+        else:
+            z = F.linear(x, self.weight, self.bias)
+        return z, self.ldj.expand(x.shape[:-1])
+
+    def inverse(self, z, context=None, extra_context=None):
+        if self.monomial:
+            return ((z - self.bias) / self.scale).index_select(-1, self.inv_permutation)
+        return F.linear(z - self.bias, self.weight_inverse)
+
+
+def affine_params(transform):
+    """(W, b, ldj) in float64 of transforms that are per point affine maps of the last dim, None for others"""
+    with torch.no_grad():
+        if isinstance(transform, ActNormBijectionCloud):
+            scale = torch.exp(-transform.log_scale.double()[0])
+            return torch.diag(scale), -transform.shift.double()[0] * scale, -transform.log_scale.double().sum()
+        if isinstance(transform, LinearLU):
+            weight = transform.weight().double()
+            bias = transform.bias.double() if transform.bias is not None else weight.new_zeros(weight.shape[0])
+            return weight, bias, torch.log(transform.upper_diag.double()).sum()
+        if isinstance(transform, FullCombiner):
+            weight = transform.w.double()
+            return weight, weight.new_zeros(weight.shape[0]), torch.linalg.slogdet(weight)[-1]
+        if isinstance(transform, ExponentialCombiner):
+            w_mat = transform.w_mat().double()
+            return torch.matrix_exp(w_mat), w_mat.new_zeros(w_mat.shape[0]), w_mat.diagonal().sum()
+        if isinstance(transform, Permuter) and transform.event_dim == -1:
+            weight = torch.eye(transform.permutation.shape[0], dtype=torch.float64,
+                               device=transform.permutation.device)[transform.permutation]
+            return weight, weight.new_zeros(weight.shape[0]), weight.new_zeros(())
+    return None
+
+
+def fold_linear(transforms):
+    """Single LinearBijection of consecutive affine transforms (applied in order), composed in float64"""
+    tensors = [x for transform in transforms for x in list(transform.parameters()) + list(transform.buffers())]
+    dtype = next((x.dtype for x in tensors if x.is_floating_point()), torch.float32)
+    weight, bias, ldj = affine_params(transforms[0])
+    for transform in transforms[1:]:
+        next_weight, next_bias, next_ldj = affine_params(transform)
+        weight, bias, ldj = next_weight @ weight, next_weight @ bias + next_bias, ldj + next_ldj
+    return LinearBijection(weight, bias, ldj, dtype=dtype)
+
+
+def fold_cif_reverses(block):
+    """Copy of CIFblock with reverse -> affine_cif -> act_norm -> reverse folded into the weights of the coupling (conditioning
+    on the last features instead) and act norm, so no feature reversal is left"""
+    block = copy.deepcopy(block)
+    coupling = block.affine_cif
+    if coupling.condition_on_last or coupling.context_dim != 0 or block.reverse.event_dim != -1:
+        return block
+    x2_size = coupling.input_dim - coupling.split_dim
+    with torch.no_grad():
+        # Conditioning input arrives unreversed, scale and shift outputs are applied to unreversed features
+        in_weight = coupling.nn.in_layer.weight
+        in_weight.copy_(in_weight.flip(-1))
+        out_layer = coupling.nn.out_layer
+        out_layer.weight.copy_(torch.cat([x.flip(0) for x in out_layer.weight.split(x2_size, dim=0)]))
+        out_layer.bias.copy_(torch.cat([x.flip(0) for x in out_layer.bias.split(x2_size, dim=0)]))
+        block.act_norm.shift.copy_(block.act_norm.shift.flip(-1))
+        block.act_norm.log_scale.copy_(block.act_norm.log_scale.flip(-1))
+    coupling.condition_on_last = True
+    block.reverse = IdentityTransform()
+    return block
+
+
+def optimize_for_inference(flow):
+    """Equivalent eval mode copy of flow with each run of act norms, linear permuters and permutations between couplings
+    folded into one LinearBijection and the reverses in CIF blocks folded away"""
+    flow = getattr(flow, 'module', flow)
+    transforms, run = [], []
+    for transform in list(flow.transforms) + [None]:
+        if transform is not None and affine_params(transform) is not None:
+            run.append(transform)
+            continue
+        if len(run) > 0:
+            transforms.append(fold_linear(run))
+            run = []
+        if transform is not None:
+            transforms.append(fold_cif_reverses(transform) if isinstance(transform, CIFblock) else copy.deepcopy(transform))
+    optimized = Flow(transforms, flow.base_dist, flow.sample_dist, precompute_kv=flow.precompute_kv)
+    return optimized.eval()
+
+
+def check_log_prob(flow, optimized, x, context=None, extra_context=None, seed=0, atol=1e-3):
+    """Max abs difference of log likelihoods of flow and optimized flow on x (same noise in the augmenters), raises if above atol"""
+    flow = getattr(flow, 'module', flow)
+    log_probs = []
+    with torch.no_grad():
+        for model in [flow, optimized]:
+            torch.manual_seed(seed)
+            log_probs.append(model.log_prob(x, context=context, extra_context=extra_context))
+    difference = (log_probs[0] - log_probs[1]).abs().max().item()
+    if difference > atol:
+        raise Exception(f'Optimized flow log likelihoods differ by {difference}')
+    return difference
@@ -23,7 +23,7 @@ class PreNorm(nn.Module):
         self.norm_context = nn.LayerNorm(
             context_dim) if exists(context_dim) else None
 
-    def forward(self, x, context):
+    def forward(self, x, context, kv=None):
         x = self.norm(x)
 
         if exists(self.norm_context):
@@ -32,6 +32,8 @@ class PreNorm(nn.Module):
         else:
             normed_context = context
 
+        if exists(kv):
+            return self.fn(x, normed_context, kv=kv)
         return self.fn(x, normed_context)
 
 
@@ -87,37 +89,124 @@ class Attention(nn.Module):
 
 
 class AttentionControlledOut(nn.Module):
-    def __init__(self, out_dim, query_dim, context_dim, heads, dim_head, dropout):
+    def __init__(self, out_dim, query_dim, context_dim, heads, dim_head, dropout, split_heads=True):
         super().__init__()
-        self.attention = AttentionMine(query_dim, context_dim, heads, dim_head)
+        self.attention = AttentionMine(query_dim, context_dim, heads, dim_head, split_heads=split_heads)
         self.lin = nn. Linear(self.attention.inner_dim, out_dim)
 
-    def forward(self, x, context=None, mask=None):
-        return self.lin(self.attention(x, context=context, mask=mask))
+    def forward(self, x, context=None, mask=None, kv=None):
+        return self.lin(self.attention(x, context=context, mask=mask, kv=kv))
+
+
+def chunked_attention(q, k, v, scale, mask=None, chunk_size=1024):
+    """Softmax attention of (..., i, d) queries over (..., j, d) keys/values in chunks of queries and keys, keeping a running
+    max and normaliser per query (online softmax) so only (chunk_size, chunk_size) scores exist at a time"""
+    out = []
+    for q_chunk in (q * scale).split(chunk_size, dim=-2):
+        max_score = torch.full(q_chunk.shape[:-1] + (1,), float('-inf'), dtype=q.dtype, device=q.device)
+        normaliser = torch.zeros_like(max_score)
+        acc = torch.zeros(q_chunk.shape[:-1] + v.shape[-1:], dtype=q.dtype, device=q.device)
+        for start in range(0, k.shape[-2], chunk_size):
+            scores = torch.matmul(q_chunk, k[..., start:start + chunk_size, :].transpose(-1, -2))
+            if exists(mask):
+                scores = scores.masked_fill(~mask[..., start:start + chunk_size], -torch.finfo(scores.dtype).max)
+            new_max = torch.maximum(max_score, scores.amax(dim=-1, keepdim=True))
+            correction = torch.exp(max_score - new_max)
+            weights = torch.exp(scores - new_max)
+            normaliser = normaliser * correction + weights.sum(dim=-1, keepdim=True)
+            acc = acc * correction + torch.matmul(weights, v[..., start:start + chunk_size, :])
+            max_score = new_max
+        out.append(acc / normaliser)
+    return torch.cat(out, dim=-2)
 
 
 class AttentionMine(nn.Module):
-    def __init__(self, query_dim, context_dim, heads, dim_head,save_attn_weights = False):
+    def __init__(self, query_dim, context_dim, heads, dim_head,save_attn_weights = False, chunk_size=1024, split_heads=True):
         super().__init__()
         self.save_attn_weights = save_attn_weights
+        self.chunk_size = chunk_size
         self.inner_dim = dim_head * heads
-        self.scale = self.inner_dim ** -0.5
+        # Without split_heads (models trained before heads were split) all heads attend as one of inner_dim
+        self.heads = heads if split_heads else 1
+        self.scale = (self.inner_dim // self.heads) ** -0.5
         self.to_q = nn.Linear(query_dim, self.inner_dim, bias=False)
         self.to_kv = nn.Linear(context_dim, self.inner_dim * 2, bias=False)
 
-    def forward(self, x, context=None, mask=None):
+    def forward(self, x, context=None, mask=None, kv=None):
+        """Multi head attention of x over context, mask (b, j) is True for context points to attend to.
+        Fused attention on gpu, chunked online softmax otherwise, full weights only materialised if saved or small"""
+        h = self.heads
         q = self.to_q(x)
-        k, v = self.to_kv(context).chunk(2, dim=-1)
-        attn_weights = F.softmax(torch.matmul(
-            q, k.transpose(1, 2))*self.scale, dim=-1)
-        attn = torch.matmul(attn_weights, v)
-        if self.save_attn_weights:
-            self.last_attn_weights = attn_weights.cpu()
-        return attn
-
-
-def get_cross_attn(out_dim, query_dim, context_dim, heads, dim_head, dropout): return PreNorm(
-    query_dim, AttentionControlledOut(out_dim, query_dim, context_dim, heads, dim_head, dropout))
+        # kv is the already computed to_kv(context) (see PrecomputedKV)
+        kv = self.to_kv(context) if kv is None else kv
+        k, v = kv.chunk(2, dim=-1)
+        q, k, v = map(lambda t: rearrange(
+            t, 'b n (h d) -> b h n d', h=h), (q, k, v))
+        if exists(mask):
+            mask = rearrange(mask, 'b j -> b () () j')
+
+        # Plain attention if weights are saved, everything fits one chunk or exporting to ONNX (the chunk loop would be
+        # exported with split sizes of the example input)
+        if self.save_attn_weights or torch.onnx.is_in_onnx_export() or max(q.shape[-2], k.shape[-2]) <= self.chunk_size:
+            sim = torch.matmul(q, k.transpose(-1, -2)) * self.scale
+            if exists(mask):
+                sim = sim.masked_fill(~mask, -torch.finfo(sim.dtype).max)
+            attn_weights = F.softmax(sim, dim=-1)
+            if self.save_attn_weights:
+                self.last_attn_weights = attn_weights.cpu()
+            attn = torch.matmul(attn_weights, v)
+        elif q.is_cuda and hasattr(F, 'scaled_dot_product_attention'):
+            # Default scale of scaled_dot_product_attention is dim_head**-0.5
+            attn = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        else:
+            attn = chunked_attention(q, k, v, self.scale, mask=mask, chunk_size=self.chunk_size)
+        return rearrange(attn, 'b h n d -> b n (h d)')
+
+
+def get_cross_attn(out_dim, query_dim, context_dim, heads, dim_head, dropout, split_heads=True): return PreNorm(
+    query_dim, AttentionControlledOut(out_dim, query_dim, context_dim, heads, dim_head, dropout, split_heads=split_heads))
+
+
+def attention_layers(module):
+    """AttentionMine layers of module that see the context unchanged (not behind a context norm)"""
+    normed = set()
+    for layer in module.modules():
+        if isinstance(layer, PreNorm) and exists(layer.norm_context):
+            normed.update(id(x) for x in layer.modules())
+    return [x for x in module.modules() if isinstance(x, AttentionMine) and id(x) not in normed]
+
+
+class PrecomputedKV:
+    """Context together with the to_kv projections of all given attention layers, computed as one stacked matmul
+    instead of one small matmul per layer"""
+
+    def __init__(self, context, layers):
+        self.context = context
+        self.kv = {}
+        if len(layers) > 0:
+            weight = torch.cat([layer.to_kv.weight for layer in layers], dim=0)
+            kv = F.linear(context, weight).split([layer.to_kv.out_features for layer in layers], dim=-1)
+            self.kv = {id(layer): x for layer, x in zip(layers, kv)}
+
+    def detached(self):
+        """Copy sharing the context with the projections as new leaves (gradients collected per layer)"""
+        copy = PrecomputedKV(self.context, [])
+        copy.kv = {key: x.detach().requires_grad_(x.requires_grad) for key, x in self.kv.items()}
+        return copy
+
+    def kv_for(self, module):
+        """Projection of the attention layer in module, None if it was not precomputed"""
+        for layer in module.modules():
+            if isinstance(layer, AttentionMine):
+                return self.kv.get(id(layer))
+        return None
+
+
+def resolve_context(context, module):
+    """Context tensor and precomputed kv (None if there is none) for the attention in module"""
+    if isinstance(context, PrecomputedKV):
+        return context.context, context.kv_for(module)
+    return context, None
 
 
 
@@ -11,8 +11,26 @@ import numpy as np
 eps = 1e-8
 
 
-
-class FullCombiner(Transform):
+class CachedDerived:
+    """Mixin caching matrices derived from the parameters for inference (eval mode without gradients), otherwise they are
+    recomputed so gradients reach the parameters. The cache is dropped once any parameter changes, in place updates bump
+    the tensor version and moves change the storage"""
+
+    def cached(self, name, fn):
+        if self.training or torch.is_grad_enabled():
+            return fn()
+        state = tuple((p.data_ptr(), p._version) for p in self.parameters())
+        cache = self.__dict__.setdefault('_derived_cache', {})
+        if cache.get('state') != state:
+            cache.clear()
+            cache['state'] = state
+        if name not in cache:
+            with torch.no_grad():
+                cache[name] = fn()
+        return cache[name]
+
+
+class FullCombiner(CachedDerived, Transform):
     def __init__(self,dim):
         super().__init__()
         self.dim = dim
@@ -21,17 +39,17 @@ class FullCombiner(Transform):
 
     def forward(self,x,context=None,extra_context=None):
         x = F.linear(x, self.w, bias=None)
-        ldj  = torch.linalg.slogdet(self.w)[-1]
+        ldj  = self.cached('ldj', lambda: torch.linalg.slogdet(self.w)[-1])
         return x,ldj
     
     def inverse(self,y,context=None,extra_context=None):
-        inv_mat = torch.linalg.inv(self.w)
+        inv_mat = self.cached('inverse', lambda: torch.linalg.inv(self.w))
         y = F.linear(y, inv_mat)
         return y
 
             
 
-class ExponentialCombiner(Transform):
+class ExponentialCombiner(CachedDerived, Transform):
     def __init__(self,dim,algo='original',eps=1e-8,eps_expm=1e-8):
         super().__init__()
         self.dim = dim
@@ -45,12 +63,15 @@ class ExponentialCombiner(Transform):
         self.eps_expm = eps_expm
  
     
+    def w_mat(self):
+        return self.rescale*torch.tanh(self.scale*self.w+self.shift) +self.reshift + self.eps
+
     def forward(self,x,context=None,extra_context=None):
-        w_mat = self.rescale*torch.tanh(self.scale*self.w+self.shift) +self.reshift + self.eps
-        return torch.matmul(expm(w_mat,eps=self.eps_expm,algo=self.algo),x.unsqueeze(-1)).squeeze(-1), w_mat.diagonal(dim1=-2,dim2=-1).sum()
+        mat, ldj = self.cached('forward', lambda: (expm(self.w_mat(),eps=self.eps_expm,algo=self.algo), self.w_mat().diagonal(dim1=-2,dim2=-1).sum()))
+        return F.linear(x, mat), ldj
     def inverse(self,y,context=None,extra_context=None):
-        w_mat = self.rescale*torch.tanh(self.scale*self.w+self.shift) +self.reshift + self.eps
-        return torch.matmul(expm(-w_mat,eps= self.eps_expm,algo=self.algo),y.unsqueeze(-1)).squeeze(-1)
+        mat = self.cached('inverse', lambda: expm(-self.w_mat(),eps= self.eps_expm,algo=self.algo))
+        return F.linear(y, mat)
 
 class Permuter(Transform):
     def __init__(self,permutation,event_dim=-1):
@@ -87,7 +108,7 @@ class Reverse(Permuter):
 
 
 
-class LinearLU(Transform):
+class LinearLU(CachedDerived, Transform):
     """
     Linear bijection where the LU decomposition of the weights are parameterized.
     Similar to the LU version of the 1x1 convolution in [1].
@@ -162,15 +183,20 @@ class LinearLU(Transform):
         return F.softplus(self.unconstrained_upper_diag) + self.eps
 
     def forward(self, x,context=None,extra_context=None):
-        L, U = self._create_lower_upper()
-        t = F.linear(x, U)
-        z = F.linear(t, L, self.bias)
-        ldj = torch.sum(torch.log(self.upper_diag)).expand(x.shape[:2])
+        if self.training:
+            L, U = self._create_lower_upper()
+            t = F.linear(x, U)
+            z = F.linear(t, L, self.bias)
+        else:
+            z = F.linear(x, self.cached('weight', self.weight), self.bias)
+        ldj = self.cached('ldj', lambda: torch.sum(torch.log(self.upper_diag))).expand(x.shape[:2])
         return z, ldj
 
     def inverse(self, z,context=None,extra_context=None):
-        L, U = self._create_lower_upper()
         if self.bias is not None: z = z - self.bias
+        if not self.training:
+            return F.linear(z, self.cached('weight_inverse', self.weight_inverse))
+        L, U = self._create_lower_upper()
         t, _ = torch.triangular_solve(z.permute((0,2,1)), L, upper=False, unitriangular=True)
         t, _ = torch.triangular_solve(t, U, upper=True, unitriangular=False)
         x = t.permute((0,2,1))
@@ -0,0 +1,124 @@
+import torch
+from models.perceiver import PrecomputedKV
+
+
+def rng_state(device):
+    return (torch.get_rng_state(), torch.cuda.get_rng_state(device) if device.type == 'cuda' else None)
+
+
+def set_rng_state(state, device):
+    torch.set_rng_state(state[0])
+    if state[1] is not None:
+        torch.cuda.set_rng_state(state[1], device)
+
+
+class ReversibleFlow(torch.autograd.Function):
+    """Transforms of a flow run without storing activations. In backward the input of each transform is rebuilt from its
+    output with inverse (RevNet style), the transform is rerun with the random state of the forward (same augment noise)
+    and backpropagated on its own. Transforms that slice (with forward_sliced, e.g. CIFblock) keep only the sliced off
+    elements to invert with, other transforms that can not be rebuilt exactly (reconstructable=False) keep their input.
+    Returns output and summed ldj"""
+
+    @staticmethod
+    def forward(ctx, flow, x, context, extra_context, *params):
+        ctx.flow = flow
+        ctx.rng_states, stored_inputs, stored_sliced = [], {}, {}
+        with torch.no_grad():
+            flow_context = flow.precompute_context(context)
+            log_prob = torch.zeros(x.shape[:-1], device=x.device, dtype=x.dtype)
+            for index, transform in enumerate(flow.transforms):
+                ctx.rng_states.append(rng_state(x.device))
+                if hasattr(transform, 'forward_sliced'):
+                    x, ldj, stored_sliced[index] = transform.forward_sliced(x, context=flow_context, extra_context=extra_context)
+                else:
+                    if not transform.reconstructable:
+                        stored_inputs[index] = x
+                    x, ldj = transform(x, context=flow_context, extra_context=extra_context)
+                log_prob += ldj
+        ctx.stored_indices = list(stored_inputs.keys())
+        ctx.sliced_indices = list(stored_sliced.keys())
+        ctx.save_for_backward(x, context, extra_context, *stored_inputs.values(), *stored_sliced.values())
+        return x, log_prob
+
+    @staticmethod
+    def backward(ctx, grad_y, grad_ldj):
+        flow = ctx.flow
+        y, context, extra_context, *stored = ctx.saved_tensors
+        stored_inputs = dict(zip(ctx.stored_indices, stored[:len(ctx.stored_indices)]))
+        stored_sliced = dict(zip(ctx.sliced_indices, stored[len(ctx.stored_indices):]))
+        params = [x for x in flow.parameters() if x.requires_grad]
+        param_index = {id(x): index for index, x in enumerate(params)}
+        grad_params = [None] * len(params)
+        grad_context = grad_extra_context = None
+
+        def accumulate(total, grad):
+            return grad if total is None else (total if grad is None else total + grad)
+
+        with torch.enable_grad():
+            context_leaf = context.detach().requires_grad_(context.requires_grad) if context is not None else None
+            extra_leaf = extra_context.detach().requires_grad_(extra_context.requires_grad) if extra_context is not None else None
+            flow_context = flow.precompute_context(context_leaf)
+            # Layers get kv leaves so the shared stacked projection is backpropagated once at the end
+            if isinstance(flow_context, PrecomputedKV):
+                precomputed_kv = flow_context
+                flow_context = precomputed_kv.detached()
+                grad_kv = {}
+
+            with torch.random.fork_rng(devices=[y.device] if y.device.type == 'cuda' else []):
+                for index in reversed(range(len(flow.transforms))):
+                    transform = flow.transforms[index]
+                    if index in stored_inputs:
+                        x = stored_inputs[index]
+                    elif index in stored_sliced:
+                        with torch.no_grad():
+                            x = transform.inverse(y, context=flow_context, extra_context=extra_context, sliced=stored_sliced[index])
+                    else:
+                        with torch.no_grad():
+                            x = transform.inverse(y, context=flow_context, extra_context=extra_context)
+                    x = x.detach().requires_grad_()
+                    set_rng_state(ctx.rng_states[index], y.device)
+                    out, ldj = transform(x, context=flow_context, extra_context=extra_leaf)
+
+                    layer_params = [p for p in transform.parameters() if p.requires_grad]
+                    kv_leaves = list(flow_context.kv.values()) if isinstance(flow_context, PrecomputedKV) else []
+                    context_inputs = [x for x in [context_leaf, extra_leaf] if x is not None and x.requires_grad]
+                    inputs = [x] + layer_params + context_inputs + kv_leaves
+                    outputs, grad_outputs = [out], [grad_y]
+                    if torch.is_tensor(ldj) and ldj.requires_grad:
+                        outputs.append(ldj)
+                        # ldj broadcast into the per point log likelihood (e.g. scalar for full combiners)
+                        grad_outputs.append(grad_ldj.sum_to_size(ldj.shape))
+                    grads = torch.autograd.grad(outputs, inputs, grad_outputs, allow_unused=True)
+
+                    grad_y, y = grads[0], x.detach()
+                    if grad_y is None:
+                        grad_y = torch.zeros_like(y)
+                    for param, grad in zip(layer_params, grads[1:1 + len(layer_params)]):
+                        grad_params[param_index[id(param)]] = accumulate(grad_params[param_index[id(param)]], grad)
+                    grads = list(grads[1 + len(layer_params):])
+                    if context_leaf is not None and context_leaf.requires_grad:
+                        grad_context = accumulate(grad_context, grads.pop(0))
+                    if extra_leaf is not None and extra_leaf.requires_grad:
+                        grad_extra_context = accumulate(grad_extra_context, grads.pop(0))
+                    for key, grad in zip(flow_context.kv.keys() if kv_leaves else [], grads):
+                        grad_kv[key] = accumulate(grad_kv.get(key), grad)
+
+            if isinstance(flow_context, PrecomputedKV) and len(grad_kv) > 0:
+                keys = list(grad_kv.keys())
+                kv_inputs = params + ([context_leaf] if context_leaf.requires_grad else [])
+                grads = torch.autograd.grad([precomputed_kv.kv[key] for key in keys], kv_inputs,
+                                            [grad_kv[key] for key in keys], allow_unused=True)
+                for index, grad in enumerate(grads[:len(params)]):
+                    grad_params[index] = accumulate(grad_params[index], grad)
+                if context_leaf.requires_grad:
+                    grad_context = accumulate(grad_context, grads[-1])
+
+        return (None, grad_y, grad_context, grad_extra_context, *grad_params)
+
+
+def reversible_log_prob(flow, x, context=None, extra_context=None):
+    """Flow log likelihood with activation memory independent of the number of transforms, apart from the sliced off
+    elements of CIF blocks ((cif_latent_dim - latent_dim) per point each)"""
+    params = [x for x in flow.parameters() if x.requires_grad]
+    z, ldj = ReversibleFlow.apply(flow, x, context, extra_context, *params)
+    return ldj + flow.base_dist.log_prob(z)
@@ -15,6 +15,8 @@ class Slice(Transform):
     '''
 
     stochastic_forward = False
+    # Sliced off elements are lost, inverse samples new ones
+    reconstructable = False
 
     def __init__(self, noise_dist, num_keep, dim=1):
         super().__init__()
@@ -43,7 +45,10 @@ class Slice(Transform):
             ldj = self.noise_dist.log_prob(x2)
         return z, ldj
 
-    def inverse(self, z, context=None):
+    def inverse(self, z, context=None, sliced=None):
+        """Concatenate z with sliced (the elements forward sliced off) or, if not given, newly sampled ones"""
+        if sliced is not None:
+            return torch.cat([z, sliced], dim=self.dim)
 
         if context is not None:
             context = torch.cat((z, context), axis=self.dim)
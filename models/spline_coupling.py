@@ -3,6 +3,7 @@ from torch import nn
 from torch._C import dtype
 from models.nets import MLP
 from models import Transform
+from models.checkpointing import checkpoint
 from torch.nn import functional as F
 import numpy as np
 from utils import sum_except_batch
@@ -14,11 +15,15 @@ DEFAULT_MIN_BIN_HEIGHT = 1e-3
 DEFAULT_MIN_DERIVATIVE = 1e-3
 
 
-def searchsorted(bin_locations, inputs, eps=1e-6):
-    bin_locations[..., -1] += eps
-    return torch.sum(inputs[..., None] >= bin_locations, dim=-1) - 1
+def searchsorted(bin_locations, inputs):
+    """Bin index of inputs given bin edges (..., num_bins + 1), inputs on the last edge belong to the last bin"""
+    inner_edges = bin_locations[..., 1:-1].contiguous()
+    return torch.searchsorted(inner_edges, inputs[..., None].contiguous(), right=True)[..., 0]
 
 
+def select_bins(values, one_hot):
+    """Value of the selected bin, masked sum over the (small) last dim instead of a gather"""
+    return (values * one_hot).sum(dim=-1)
 
 
 def unconstrained_rational_quadratic_spline(inputs,
@@ -31,41 +36,53 @@ def unconstrained_rational_quadratic_spline(inputs,
                                             min_bin_width=DEFAULT_MIN_BIN_WIDTH,
                                             min_bin_height=DEFAULT_MIN_BIN_HEIGHT,
                                             min_derivative=DEFAULT_MIN_DERIVATIVE):
-
-    inside_interval_mask = (inputs >= -tail_bound) & (inputs <= tail_bound)
-    outside_interval_mask = ~inside_interval_mask
-
-    outputs = torch.zeros_like(inputs)
-    logabsdet = torch.zeros_like(inputs)
+    """Spline inside [-tail_bound, tail_bound], identity outside. All inputs go through the spline (clamped into the
+    interval) and the tails are selected afterwards so shapes never depend on the data"""
 
     if tails == 'linear':
-        unnormalized_derivatives = F.pad(unnormalized_derivatives, pad=(1, 1))
-        constant = torch.tensor(math.log(math.exp((1 - min_derivative) - 1)))
-        unnormalized_derivatives[..., 0] = constant
-        unnormalized_derivatives[..., -1] = constant
-
-        outputs[outside_interval_mask] = inputs[outside_interval_mask]
-        logabsdet[outside_interval_mask] = 0
+        constant = math.log(math.exp((1 - min_derivative) - 1))
+        unnormalized_derivatives = F.pad(unnormalized_derivatives, pad=(1, 1), value=constant)
     else:
         raise RuntimeError('{} tails are not implemented.'.format(tails))
 
-    a, b = rational_quadratic_spline(
-        inputs=inputs[inside_interval_mask],
-        unnormalized_widths=unnormalized_widths[inside_interval_mask, :],
-        unnormalized_heights=unnormalized_heights[inside_interval_mask, :],
-        unnormalized_derivatives=unnormalized_derivatives[inside_interval_mask, :],
+    inside_interval_mask = (inputs >= -tail_bound) & (inputs <= tail_bound)
+    outputs, logabsdet = rational_quadratic_spline(
+        inputs=inputs.clamp(-tail_bound, tail_bound),
+        unnormalized_widths=unnormalized_widths,
+        unnormalized_heights=unnormalized_heights,
+        unnormalized_derivatives=unnormalized_derivatives,
         inverse=inverse,
         left=-tail_bound, right=tail_bound, bottom=-tail_bound, top=tail_bound,
         min_bin_width=min_bin_width,
         min_bin_height=min_bin_height,
         min_derivative=min_derivative
     )
-    outputs[inside_interval_mask] = a.type(outputs.dtype)
-    logabsdet[inside_interval_mask] = b.type(logabsdet.dtype)
+    outputs = torch.where(inside_interval_mask, outputs.type(inputs.dtype), inputs)
+    logabsdet = torch.where(inside_interval_mask, logabsdet.type(inputs.dtype), torch.zeros_like(inputs))
 
     return outputs, logabsdet
 
 
+class CompiledOrEager:
+    """torch.compile'd fn where available, falling back to eager fn for good if compiling fails (e.g. no compiler)"""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.compiled = torch.compile(fn) if hasattr(torch, 'compile') else None
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as e:
+                print(f'Compiling {self.fn.__name__} failed, running eager: {e}')
+                self.compiled = None
+        return self.fn(*args, **kwargs)
+
+
+spline = CompiledOrEager(unconstrained_rational_quadratic_spline)
+
+
 def rational_quadratic_spline(inputs,
                               unnormalized_widths,
                               unnormalized_heights,
@@ -75,9 +92,7 @@ def rational_quadratic_spline(inputs,
                               min_bin_width=DEFAULT_MIN_BIN_WIDTH,
                               min_bin_height=DEFAULT_MIN_BIN_HEIGHT,
                               min_derivative=DEFAULT_MIN_DERIVATIVE):
-    if torch.min(inputs) < left or torch.max(inputs) > right:
-        raise Exception()
-
+    """Rational quadratic spline of inputs within [left, right] (no check, inputs are expected to be clamped)"""
     num_bins = unnormalized_widths.shape[-1]
 
     if min_bin_width * num_bins > 1.0:
@@ -106,22 +121,23 @@ def rational_quadratic_spline(inputs,
     heights = cumheights[..., 1:] - cumheights[..., :-1]
 
     if inverse:
-        bin_idx = searchsorted(cumheights, inputs)[..., None]
+        bin_idx = searchsorted(cumheights, inputs)
     else:
-        bin_idx = searchsorted(cumwidths, inputs)[..., None]
+        bin_idx = searchsorted(cumwidths, inputs)
+    one_hot = (bin_idx[..., None] == torch.arange(num_bins, device=inputs.device)).type(widths.dtype)
 
-    input_cumwidths = cumwidths.gather(-1, bin_idx)[..., 0]
-    input_bin_widths = widths.gather(-1, bin_idx)[..., 0]
+    input_cumwidths = select_bins(cumwidths[..., :-1], one_hot)
+    input_bin_widths = select_bins(widths, one_hot)
 
-    input_cumheights = cumheights.gather(-1, bin_idx)[..., 0]
+    input_cumheights = select_bins(cumheights[..., :-1], one_hot)
     delta = heights / widths
-    input_delta = delta.gather(-1, bin_idx)[..., 0]
+    input_delta = select_bins(delta, one_hot)
 
-    input_derivatives = derivatives.gather(-1, bin_idx)[..., 0]
-    input_derivatives_plus_one = derivatives[...,
-                                             1:].gather(-1, bin_idx)[..., 0]
+    # Derivatives beyond the last knot (the coupling passes num_bins + 1 before padding) are unused
+    input_derivatives = select_bins(derivatives[..., :num_bins], one_hot)
+    input_derivatives_plus_one = select_bins(derivatives[..., 1:num_bins + 1], one_hot)
 
-    input_heights = heights.gather(-1, bin_idx)[..., 0]
+    input_heights = select_bins(heights, one_hot)
 
     if inverse:
         a = (((inputs - input_cumheights) * (input_derivatives
@@ -134,8 +150,8 @@ def rational_quadratic_spline(inputs,
                                               - 2 * input_delta))
         c = - input_delta * (inputs - input_cumheights)
 
-        discriminant = b.pow(2) - 4 * a * c
-        assert (discriminant >= 0).all()
+        # Non negative up to rounding
+        discriminant = (b.pow(2) - 4 * a * c).clamp_min(0)
 
         root = (2 * c) / (-b - torch.sqrt(discriminant))
         outputs = root * input_bin_widths + input_cumwidths
@@ -170,6 +186,8 @@ def rational_quadratic_spline(inputs,
 
 
 class RationalQuadraticSplineCoupling(Transform):
+    checkpointable = True
+
     def __init__(self, input_dim, hidden_dims, nonlinearity, num_bins, context_dim=0, event_dim=-1):
         super().__init__()
         self.event_dim = event_dim
@@ -191,18 +209,16 @@ class RationalQuadraticSplineCoupling(Transform):
         nn_input = torch.cat(
             (x1, context), dim=self.event_dim) if self.context_dim != 0 else x1
 
-        nn_out = torch.utils.checkpoint.checkpoint(
-            self.nn, nn_input, preserve_rng_state=False)
+        nn_out = checkpoint(self, self.nn, nn_input)
         unnormalized_widths, unnormalized_heights, unnormalized_derivatives = nn_out.reshape(
             nn_input.shape[:2]+(-1, self._output_dim_multiplier())).split([self.num_bins, self.num_bins, self.num_bins+1], dim=self.event_dim)
 
         # Inverse not specified as default is false
-        y2, ldj = torch.utils.checkpoint.checkpoint(unconstrained_rational_quadratic_spline,
-                                                    x2,
-                                                    unnormalized_widths,
-                                                    unnormalized_heights,
-                                                    unnormalized_derivatives,
-                                                    preserve_rng_state=False)
+        y2, ldj = checkpoint(self, spline,
+                             x2,
+                             unnormalized_widths,
+                             unnormalized_heights,
+                             unnormalized_derivatives)
       
         ldj = sum_except_batch(ldj, num_dims=2)
 
@@ -218,10 +234,43 @@ class RationalQuadraticSplineCoupling(Transform):
             (y1, context), dim=self.event_dim) if self.context_dim != 0 else y1
         unnormalized_widths, unnormalized_heights, unnormalized_derivatives = self.nn(nn_input).reshape(
             nn_input.shape[:2]+(-1, self._output_dim_multiplier())).split([self.num_bins, self.num_bins, self.num_bins+1], dim=self.event_dim)
-        x2, _ = unconstrained_rational_quadratic_spline(y2,
+        x2, _ = spline(y2,
                                                         unnormalized_widths=unnormalized_widths,
                                                         unnormalized_heights=unnormalized_heights,
                                                         unnormalized_derivatives=unnormalized_derivatives,
                                                         inverse=True)
 
         return torch.cat([x1, x2], dim=self.event_dim)
+
+
+if __name__ == '__main__':
+    # Benchmark forward and inverse of the coupling with the previous (mask-packing) kernel and the eager and compiled
+    # fixed-shape kernel, with the max difference of outputs and log determinants to the previous kernel
+    import time
+    from models.spline_reference import unconstrained_rational_quadratic_spline as previous_spline
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = RationalQuadraticSplineCoupling(6, [64, 64], nn.ReLU(), num_bins=8, context_dim=24).to(device)
+    x = torch.randn((20, 2000, 6), device=device) * 2
+    context = torch.randn((20, 2000, 24), device=device)
+    kernel = spline
+    compiled = kernel.compiled
+    previous = {}
+    for name in ['previous', 'eager', 'compiled']:
+        # The coupling calls the module level spline
+        spline = previous_spline if name == 'previous' else kernel
+        kernel.compiled = compiled if name == 'compiled' else None
+        for direction, fn in [('forward', lambda: model(x, context)), ('inverse', lambda: (model.inverse(x, context), None))]:
+            with torch.no_grad():
+                outputs = fn()
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+                for _ in range(10):
+                    fn()
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+            elapsed = (time.time() - start) / 10
+            if name == 'previous':
+                previous[direction] = (outputs, elapsed)
+            difference = max((a - b).abs().max().item() for a, b in zip(outputs, previous[direction][0]) if a is not None)
+            print(f'{name:>8} {direction}: {elapsed * 1000:.1f} ms (x{previous[direction][1] / elapsed:.2f}), max difference {difference:.1e}')
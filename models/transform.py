@@ -1,10 +1,14 @@
 import torch
 
 import torch.nn as nn
+from models.perceiver import PrecomputedKV, attention_layers
+from models.reversible import reversible_log_prob
 
 #Code adapted from : https://github.com/didriknielsen/survae_flows/
 
 class Transform(torch.nn.Module):
+    # Input can be rebuilt exactly from the output with inverse (see ReversibleFlow)
+    reconstructable = True
 
     def __init__(self):
         super().__init__()
@@ -61,13 +65,29 @@ class PreConditionApplier(Transform):
 class Flow(Transform):
     '''Wrapper for merging multiple transforms'''
 
-    def __init__(self,transform_list,base_dist,sample_dist=None):
+    def __init__(self,transform_list,base_dist,sample_dist=None,precompute_kv=True,reversible=False):
         super().__init__()
         self.base_dist = base_dist
         self.sample_dist = sample_dist if sample_dist!=None else base_dist
         self.transforms = nn.ModuleList(transform_list)
+        self.precompute_kv = precompute_kv
+        self.reversible = reversible
+
+    def precompute_context(self, context):
+        """Context with the attention key/values of all layers projected at once (PrecomputedKV) if enabled"""
+        if not self.precompute_kv or context is None or isinstance(context, PrecomputedKV):
+            return context
+        return PrecomputedKV(context, attention_layers(self))
+
+    def use_reversible(self, context):
+        """Reversible backward once act norms are initialized and the context is a plain tensor"""
+        initialized = all(bool(x.initialized) for x in self.modules() if hasattr(x, 'initialized'))
+        return self.reversible and torch.is_grad_enabled() and initialized and not isinstance(context, PrecomputedKV)
 
     def log_prob(self, x,context=None,extra_context=None):
+        if self.use_reversible(context):
+            return reversible_log_prob(self, x, context=context, extra_context=extra_context)
+        context = self.precompute_context(context)
         log_prob = torch.zeros(x.shape[:-1], device=x.device,dtype=x.dtype)
         for index,transform in enumerate(self.transforms):
             x, ldj = transform(x,context=context,extra_context=extra_context)
@@ -79,6 +99,7 @@ class Flow(Transform):
     def sample(self,num_samples,n_points,context=None,sample_distrib=None,extra_context=None):
         dist_for_sample = sample_distrib if sample_distrib!= None else self.sample_dist
         z = dist_for_sample.sample(num_samples,n_points=n_points)
+        context = self.precompute_context(context)
         for transform in reversed(self.transforms):
             z = transform.inverse(z,context=context,extra_context=extra_context)
         return z
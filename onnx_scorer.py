@@ -0,0 +1,40 @@
+import os
+import json
+import numpy as np
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class OnnxScorer:
+    """Log likelihoods as inner_loop from a model exported with export_flow.export_onnx, run by ONNX Runtime on CPU.
+    Needs only numpy and onnxruntime (no torch) at inference"""
+
+    def __init__(self, path, intra_op_threads=None):
+        if onnxruntime is None:
+            raise Exception('OnnxScorer needs onnxruntime')
+        with open(os.path.splitext(path)[0] + '.json') as f:
+            self.meta = json.load(f)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads is not None:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = onnxruntime.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.rng = np.random.default_rng()
+
+    def __call__(self, extract_0, extract_1, extra_context=None, noise=None, seed=None):
+        """Log likelihood of extract_1 (b,n,d) given extract_0 (b,m,d), extra_context (b,c). Augmenter noise is sampled
+        (seeded if seed given) unless given as list of (b,n,noise_dims[i]) arrays"""
+        batch_size, n_points = extract_1.shape[:2]
+        if noise is None:
+            rng = self.rng if seed is None else np.random.default_rng(seed)
+            noise = [rng.standard_normal((batch_size, n_points, dim), dtype=np.float32) for dim in self.meta['noise_dims']]
+        inputs = [extract_0, extract_1]
+        if self.meta['using_extra_context']:
+            if extra_context is None:
+                raise Exception('Model uses extra_context')
+            inputs.append(np.repeat(extra_context[:, None], n_points, axis=1))
+        inputs = inputs + list(noise)
+        feed = {name: np.ascontiguousarray(x, dtype=np.float32) for name, x in zip(self.meta['input_names'], inputs)}
+        return self.session.run(['log_prob'], feed)[0]
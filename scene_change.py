@@ -7,9 +7,8 @@ from utils import (
 config_loader,
 extract_area,
 random_subsample,
-save_las,get_all_voxel_centers,
+save_las,VoxelGrid,
 )
-from torch_cluster import grid_cluster
 from dataloaders.dataset_utils import registration_pipeline
 
 
@@ -28,11 +27,14 @@ def change_map(cloud_0,cloud_1,model_path,change_func,out_path,batch_size,sample
     cloud_0,cloud_1 = registration_pipeline([cloud_0,cloud_1],0.05,0.07)
     cloud_0 = cloud_0[extract_area(cloud_0,center,config['clearance'],shape='square'),...]
     cloud_1 = cloud_1[extract_area(cloud_1,center,config['clearance'],shape='square'),...]
-    start,end = cloud_0.min(dim=0),cloud_0.max(dim=0)
-    
-    cluster_0 = grid_cluster(cloud_0[:,:3])
-    voxel_centers = get_all_voxel_centers(start,end,config['final_voxel_size'])
-    cluster_1 = grid_cluster(cloud_1[:,:3])
+    start = torch.minimum(cloud_0[:,:3].min(dim=0)[0],cloud_1[:,:3].min(dim=0)[0])
+    end = torch.maximum(cloud_0[:,:3].max(dim=0)[0],cloud_1[:,:3].max(dim=0)[0])
+    grid = VoxelGrid(start,end,config['final_voxel_size'])
+    # Only voxels occupied in either cloud
+    cluster_0 = grid.keys(cloud_0[:,:3])
+    cluster_1 = grid.keys(cloud_1[:,:3])
+    occupied = torch.unique(torch.cat((cluster_0,cluster_1)))
+    voxel_centers = grid.centers(occupied)
 
 
 
@@ -1,5 +1,5 @@
 import torch
-from train import initialize_flow, load_flow, inner_loop, make_sample
+from train import initialize_flow, load_flow, inner_loop, make_sample, EmbeddingCache
 from dataloaders import ChallengeDataset, AmsVoxelLoader
 import os
 from utils import view_cloud_plotly,log_prob_to_color,is_valid
@@ -23,6 +23,21 @@ model_dict = initialize_flow(config, device, mode='test')
 model_dict = load_flow(save_dict, model_dict)
 mode = 'test'
 
+# Set to score with linear layers of the flow folded (see models.optimize_for_inference)
+optimize_flow = False
+if optimize_flow:
+    # Fold linear layers of the flow, checked on a random cloud and context
+    with torch.no_grad():
+        check_context = model_dict['input_embedder'](torch.randn((1, config['n_samples_context'], config['input_dim']), device=device))
+    if config['global']:
+        check_context = check_context.unsqueeze(1)
+    check_extra_context = torch.zeros((1, config['sample_size'], config['extra_context_dim']), device=device) if config['using_extra_context'] else None
+    optimized_flow = models.optimize_for_inference(model_dict['flow'])
+    difference = models.check_log_prob(model_dict['flow'], optimized_flow, torch.randn((1, config['sample_size'], config['input_dim']), device=device),
+                                       context=check_context, extra_context=check_extra_context)
+    print(f'Optimized flow, max log likelihood difference: {difference}')
+    model_dict['flow'] = optimized_flow
+
 
 one_up_path = os.path.dirname(__file__)
 out_path = os.path.join(one_up_path, r"save/processed_dataset")
@@ -33,6 +48,8 @@ dirs = ['save/challenge_data/Shrec_change_detection_dataset_public/' +
         year for year in ["2016", "2020"]]
 dataset = ChallengeDataset(csv_path, dirs, out_path, n_samples=config['sample_size'], preload=preload, device=device, final_voxel_size=config[
                            'final_voxel_size'], n_samples_context=config['n_samples_context'], context_voxel_size=config['context_voxel_size'])
+# Contexts are revisited per direction, slider move and sampling std
+embedding_cache = EmbeddingCache(store_kv=True)
 
 def evaluate_on_test(model_path,batch_size = None):
     device = 'cuda'
@@ -65,9 +82,9 @@ def evaluate_on_test(model_path,batch_size = None):
     return nats_avg
 
     
-def calc_change(batch, model_dict, config):
+def calc_change(batch, model_dict, config, input_embeddings=None):
 
-    loss, log_prob_1_given_0, _ = inner_loop(batch, model_dict, config)
+    loss, log_prob_1_given_0, _ = inner_loop(batch, model_dict, config, input_embeddings=input_embeddings)
 
     return log_prob_1_given_0.squeeze()
 
@@ -96,12 +113,14 @@ def dataset_view(dataset, index, multiple=3., gen_std=0.6, show=False):
         procesed_dict = {x: [] for x in vars}
 
 
-        def get_lob_prob(voxel,context_voxel):
+        def get_lob_prob(voxel,context_voxel,cache_key):
             voxel,context_voxel,inverse = dataset.last_processing(voxel,context_voxel)
             extra_context = inverse['mean'][2].reshape(-1,1)
+            input_embeddings = embedding_cache.get((load_path, index, config['n_samples_context'], *cache_key),
+                                                   context_voxel.unsqueeze(0), model_dict, config)
             log_prob_1_given_0 = calc_change(
-                [context_voxel.unsqueeze(0), voxel.unsqueeze(0),extra_context], model_dict, config).cpu()
-            return voxel,context_voxel,inverse,log_prob_1_given_0
+                [context_voxel.unsqueeze(0), voxel.unsqueeze(0),extra_context], model_dict, config, input_embeddings=input_embeddings).cpu()
+            return voxel,context_voxel,inverse,log_prob_1_given_0,input_embeddings
 
         def to_dev(x, device):
             try:
@@ -117,18 +136,18 @@ def dataset_view(dataset, index, multiple=3., gen_std=0.6, show=False):
 
 
 
-            _,context_for_1,inverse_1,log_prob_1_given_0 = get_lob_prob(voxel_1,context_for_1)
-            _,_,_,log_prob_0_given_0 = get_lob_prob(voxel_0,context_0_0)
-            _,context_for_0,inverse_0,log_prob_0_given_1 = get_lob_prob(voxel_0,context_for_0)
-            _,_,_,log_prob_1_given_1 = get_lob_prob(voxel_1,context_1_1)
+            _,context_for_1,inverse_1,log_prob_1_given_0,embeddings_for_1 = get_lob_prob(voxel_1,context_for_1,(key,'1_given_0'))
+            _,_,_,log_prob_0_given_0,_ = get_lob_prob(voxel_0,context_0_0,(key,'0_given_0'))
+            _,context_for_0,inverse_0,log_prob_0_given_1,embeddings_for_0 = get_lob_prob(voxel_0,context_for_0,(key,'0_given_1'))
+            _,_,_,log_prob_1_given_1,_ = get_lob_prob(voxel_1,context_1_1,(key,'1_given_1'))
 
                 
 
 
             gen_given_0 = make_sample(1024, context_for_1.unsqueeze(
-                0), model_dict, config, sample_distrib=sample_distrib,extra_context=extra_context)
+                0), model_dict, config, sample_distrib=sample_distrib,extra_context=extra_context,input_embeddings=embeddings_for_1)
             gen_given_1 = make_sample(1024, context_for_0.unsqueeze(
-                0), model_dict, config, sample_distrib=sample_distrib,extra_context=extra_context)
+                0), model_dict, config, sample_distrib=sample_distrib,extra_context=extra_context,input_embeddings=embeddings_for_0)
             gen_given_0[:, :3] = inverse_map(gen_given_0[:, :3],inverse_1)
             gen_given_1[:, :3] = inverse_map(gen_given_1[:, :3],inverse_0)
             procesed_dict['gen_given_0'].append(gen_given_0.cpu())
@@ -144,6 +163,7 @@ def dataset_view(dataset, index, multiple=3., gen_std=0.6, show=False):
             procesed_dict['voxel_0'].append(voxel_0.cpu())
             procesed_dict['voxel_1'].append(voxel_1.cpu())
 
+        print(f'Embedding cache: {embedding_cache.stats()}')
         procesed_dict = {key: torch.cat(val, dim=0)
                          for key, val in procesed_dict.items()}
         fig_gen_given_0 = view_cloud_plotly(
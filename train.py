@@ -1,5 +1,6 @@
 import math
 import os
+from collections import OrderedDict
 from time import perf_counter
 import numpy as np
 import torch
@@ -8,7 +9,7 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 import models
 import wandb
-from dataloaders import AmsVoxelLoader
+from dataloaders import AmsVoxelLoader, collate_voxel_batch
 from utils import Scheduler, is_valid
 import einops
 
@@ -42,8 +43,10 @@ def initialize_flow(config, device='cuda', mode='train'):
 
 
     #out_dim,query_dim, context_dim, heads, dim_head, dropout
+    # Configs of checkpoints trained before attention heads were split lack attention_split_heads
     attn = lambda: models.get_cross_attn(config['attn_dim'], config['attn_input_dim'],
-                                             config['input_embedding_dim'], config['cross_heads'], config['cross_dim_head'], config['attn_dropout'])
+                                             config['input_embedding_dim'], config['cross_heads'], config['cross_dim_head'], config['attn_dropout'],
+                                             split_heads=config.get('attention_split_heads', False))
 
     if config['coupling_block_nonlinearity'] == "ELU":
         coupling_block_nonlinearity = nn.ELU()
@@ -108,7 +111,7 @@ def initialize_flow(config, device='cuda', mode='train'):
 
     if config['permuter_type'] == 'ExponentialCombiner':
         def permuter(dim): return models.ExponentialCombiner(
-            dim, eps_expm=config['eps_expm'])
+            dim, eps_expm=config['eps_expm'], algo=config.get('combiner_expm_algo', 'original'))
     elif config['permuter_type'] == "random_permute":
         def permuter(dim): return models.Permuter(
             permutation=torch.randperm(dim, dtype=torch.long).to(device))
@@ -146,7 +149,9 @@ def initialize_flow(config, device='cuda', mode='train'):
 
 
 
-    final_flow = models.Flow(transforms, base_dist, sample_dist)
+    final_flow = models.Flow(transforms, base_dist, sample_dist, precompute_kv=config.get('precompute_kv', True), reversible=config.get('reversible_flow', False))
+    # Reversible backward recomputes each transform once anyway
+    (models.CheckpointPolicy('none') if config.get('reversible_flow', False) else models.CheckpointPolicy.from_config(config)).apply(final_flow, config)
 
     if config['input_embedder'] == 'DGCNNembedder':
         input_embedder = models.DGCNNembedder(
@@ -191,16 +196,18 @@ def initialize_flow(config, device='cuda', mode='train'):
 
 
     
-def inner_loop(batch, models_dict, config):
+def inner_loop(batch, models_dict, config, input_embeddings=None):
 
     
-    """Computes forward pass of given batch through model, returns mean negative log likelihood loss,log likelihood and bits per dim"""   
+    """Computes forward pass of given batch through model, returns mean negative log likelihood loss,log likelihood and bits per dim.
+    input_embeddings of extract_0 can be given if already computed (e.g. from EmbeddingCache)"""   
     extract_0, extract_1,extra_context = batch
 
     if extra_context!=None:
         extra_context = einops.repeat(extra_context,'b c-> b n c',n = config['sample_size'])
     
-    input_embeddings = models_dict["input_embedder"](extract_0)
+    if input_embeddings is None:
+        input_embeddings = models_dict["input_embedder"](extract_0)
 
 
     if config['global']:
@@ -216,10 +223,11 @@ def inner_loop(batch, models_dict, config):
     return loss, log_prob, bpd
 
 
-def make_sample(n_points, extract_0,models_dict, config, sample_distrib=None,extra_context=None):
+def make_sample(n_points, extract_0,models_dict, config, sample_distrib=None,extra_context=None,input_embeddings=None):
     """Computes inverse/generative pass of given model generating n_points given context extract_0,extra_context"""
 
-    input_embeddings = models_dict["input_embedder"](extract_0)
+    if input_embeddings is None:
+        input_embeddings = models_dict["input_embedder"](extract_0)
 
     if extra_context!=None:
         extra_context = einops.repeat(extra_context,'b c-> b n c',n = n_points)
@@ -231,6 +239,78 @@ def make_sample(n_points, extract_0,models_dict, config, sample_distrib=None,ext
     return x
 
 
+def score_points(points, extract_0, models_dict, config, extra_context=None, chunk_size=None, input_embeddings=None):
+    """Log likelihood of every one of (n,d) points given context extract_0 (1,m,d), both normalized as in training.
+    The context is embedded once and points are streamed through the flow in chunks of chunk_size (sample_size by default),
+    which is exact since attention only goes from points to context, so the scored voxel needs no subsampling"""
+    chunk_size = config['sample_size'] if chunk_size is None else chunk_size
+    with torch.no_grad():
+        if input_embeddings is None:
+            input_embeddings = models_dict["input_embedder"](extract_0)
+        if config['global']:
+            input_embeddings = input_embeddings.unsqueeze(1)
+        chunk_extra_context = einops.repeat(extra_context,'b c-> b n c',n = chunk_size) if extra_context!=None else None
+
+        log_probs = []
+        for start in range(0, points.shape[0], chunk_size):
+            chunk = points[start:start+chunk_size]
+            n_valid = chunk.shape[0]
+            if n_valid < chunk_size:
+                # Last chunk is padded with repeated points, parts of the flow may expect sample_size points
+                chunk = torch.cat((chunk, chunk[torch.arange(chunk_size-n_valid, device=chunk.device) % n_valid]))
+            log_prob = models_dict['flow'].log_prob(chunk.unsqueeze(0), context=input_embeddings, extra_context=chunk_extra_context)
+            log_probs.append(log_prob[0, :n_valid])
+    return torch.cat(log_probs)
+
+
+class EmbeddingCache:
+    """Size bounded LRU cache of context embeddings for repeated queries of the same context voxel. Keys are chosen by
+    the caller, e.g. (checkpoint, scan id, voxel key, sampling parameters). With store_kv the attention keys/values of all
+    flow layers are cached too (as PrecomputedKV). Hits and misses are counted"""
+
+    def __init__(self, max_bytes=2**30, store_kv=False):
+        self.max_bytes = max_bytes
+        self.store_kv = store_kv
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def entry_bytes(entry):
+        tensors = [entry.context, *entry.kv.values()] if isinstance(entry, models.PrecomputedKV) else [entry]
+        return sum(x.numel() * x.element_size() for x in tensors)
+
+    def get(self, key, extract_0, models_dict, config):
+        """Embedding of context extract_0 (as input_embedder output, or PrecomputedKV if store_kv) from cache or computed"""
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        with torch.no_grad():
+            entry = models_dict["input_embedder"](extract_0)
+            flow = getattr(models_dict['flow'], 'module', models_dict['flow'])
+            if self.store_kv and not config['global']:
+                entry = models.PrecomputedKV(entry, models.attention_layers(flow))
+        self.entries[key] = entry
+        self.n_bytes += self.entry_bytes(entry)
+        # Least recently used first, the newest entry is always kept
+        while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.n_bytes -= self.entry_bytes(evicted)
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+        self.n_bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total > 0 else 0.,
+                'entries': len(self.entries), 'bytes': self.n_bytes}
+
+
 def main():
 
 
@@ -247,7 +327,9 @@ def main():
     if config['data_loader'] == 'AmsVoxelLoader':
         dataset = AmsVoxelLoader(config['directory_path_train'],config['directory_path_test'], out_path='save/processed_dataset', preload=config['preload'],
         n_samples = config['sample_size'],final_voxel_size = config['final_voxel_size'],device=device,
-        n_samples_context = config['n_samples_context'], context_voxel_size = config['context_voxel_size'],mode='train',getter_mode = config['dataset_get_mode']
+        n_samples_context = config['n_samples_context'], context_voxel_size = config['context_voxel_size'],mode='train',getter_mode = config['dataset_get_mode'],
+        n_workers = config['preprocess_workers'],fps_cache = config['fps_cache'],batch_processing = config['batch_processing'],
+        registration_backend = config['registration_backend']
         )
      
     else:
@@ -256,7 +338,7 @@ def main():
 
   
     dataloader = DataLoader(dataset, shuffle=True, batch_size=config['batch_size'], num_workers=config[
-                            "num_workers"], collate_fn=None, pin_memory=True, prefetch_factor=2, drop_last=True)
+                            "num_workers"], collate_fn=collate_voxel_batch if config['batch_processing'] else None, pin_memory=True, prefetch_factor=2, drop_last=True)
 
     if config["optimizer_type"] == 'Adam':
         optimizer = torch.optim.Adam(
@@ -308,7 +390,10 @@ def main():
                 if config['time_stats']:
                     torch.cuda.synchronize()
                     t0 = perf_counter()
-                batch = [x.to(device) for x in batch]
+                if config['batch_processing']:
+                    batch = dataset.process_batch(batch, device)
+                else:
+                    batch = [x.to(device) for x in batch]
 
                 # Set to None if not using
                 if not config['using_extra_context']:
@@ -2,7 +2,11 @@ from numpy.core.numeric import Inf
 import torch
 import numpy as np
 import time
-from laspy.file import File
+try:
+    from laspy.file import File
+except ImportError:
+    # laspy >= 2 dropped the legacy File api
+    File = None
 import pandas as pd
 import plotly.graph_objects as go
 import matplotlib.pyplot as plt
@@ -27,32 +31,90 @@ from knn import get_knn
 eps = 1e-8
 
 
-def load_las(path, extra_dim_list=None, scale_colors=True):
-    """Load las/laz from given path, laz fiels require laszip on path"""
-    input_las = File(path, mode='r')
-    point_records = input_las.points.copy()
-    las_scaleX = input_las.header.scale[0]
-    las_offsetX = input_las.header.offset[0]
-    las_scaleY = input_las.header.scale[1]
-    las_offsetY = input_las.header.offset[1]
-    las_scaleZ = input_las.header.scale[2]
-    las_offsetZ = input_las.header.offset[2]
-
-    # calculating coordinates
-    if scale_colors:
-        color_div = 65536
+def _las_raw_chunks(path, chunk_size, names):
+    """Yield (scale, offset, {name: raw array}) per chunk of at most chunk_size points, only reading given dimension names"""
+    if hasattr(laspy, 'open'):
+        # laspy >= 2 streams (and decompresses laz) chunk by chunk
+        with laspy.open(path) as reader:
+            header = reader.header
+            available = set(header.point_format.dimension_names)
+            missing = [x for x in names if x not in available]
+            if missing:
+                raise Exception(f'Dimensions {missing} not in {path}')
+            for points in reader.chunk_iterator(chunk_size):
+                yield header.scales, header.offsets, {x: np.asarray(points[x]) for x in names}
     else:
-        color_div = 1
-    p_X = np.array((point_records['point']['X'] * las_scaleX) + las_offsetX)
-    p_Y = np.array((point_records['point']['Y'] * las_scaleY) + las_offsetY)
-    p_Z = np.array((point_records['point']['Z'] * las_scaleZ) + las_offsetZ)
-    try:
-        points = np.vstack((p_X, p_Y, p_Z, input_las.red/color_div,
-                           input_las.green/color_div, input_las.blue/color_div)).T
-    except:
-        pass
+        # Legacy laspy exposes the point records as a memory map, slice it instead of copying
+        input_las = File(path, mode='r')
+        try:
+            available = set(input_las.point_format.lookup.keys())
+            missing = [x for x in names if x not in available]
+            if missing:
+                raise Exception(f'Dimensions {missing} not in {path}')
+            dims = {x: input_las.reader.get_dimension(x) for x in names}
+            n_points = input_las.header.point_records_count
+            for start in range(0, n_points, chunk_size):
+                yield input_las.header.scale, input_las.header.offset, {key: np.array(val[start:start+chunk_size]) for key, val in dims.items()}
+        finally:
+            input_las.close()
+
+
+def iter_las_chunks(path, chunk_size=2_000_000, rgb=True, scale_colors=True, origin=None,
+                    center=None, clearance=None, shape='square', dtype=np.float32, extra_dims=None):
+    """Stream las/laz from given path as (xyz, rgb) chunks of at most chunk_size points, rgb is None if not requested.
+    If extra_dims (list of dimension names, e.g. 'intensity') is given chunks are (xyz, rgb, extra) with extra (n, len(extra_dims)).
+    Coordinates are shifted by origin in float64 before casting to dtype, if center and clearance are given
+    only points within extract_area of the chunk are yielded"""
+    names = ['X', 'Y', 'Z']
+    if rgb:
+        names += ['red', 'green', 'blue']
+    if extra_dims is not None:
+        names += [x for x in extra_dims if x not in names]
+    color_div = 65536 if scale_colors else 1
+    origin = np.zeros(3) if origin is None else np.asarray(origin, dtype=np.float64)
+    if len(origin) == 2:
+        origin = np.append(origin, 0.)
+    for scale, offset, raw in _las_raw_chunks(path, chunk_size, names):
+        xyz = np.empty((raw['X'].shape[0], 3), dtype=np.float64)
+        for axis, name in enumerate(['X', 'Y', 'Z']):
+            xyz[:, axis] = raw[name] * scale[axis] + offset[axis]
+        if clearance is not None:
+            mask = _area_mask(xyz, center, clearance, shape)
+            if not mask.any():
+                continue
+            xyz = xyz[mask]
+        else:
+            mask = slice(None)
+        xyz -= origin
+        colors = None
+        if rgb:
+            colors = np.stack([raw[x][mask] for x in ['red', 'green', 'blue']], axis=-1).astype(dtype)
+            colors /= color_div
+        if extra_dims is None:
+            yield xyz.astype(dtype), colors
+        else:
+            yield xyz.astype(dtype), colors, np.stack([raw[x][mask] for x in extra_dims], axis=-1).astype(dtype)
 
-    return points
+
+def _area_mask(xyz, center, clearance, shape='square'):
+    """Numpy version of extract_area for chunks"""
+    if shape == 'square':
+        return (np.abs(xyz[:, 0] - center[0]) < clearance) & (np.abs(xyz[:, 1] - center[1]) < clearance)
+    elif shape == 'circle':
+        return np.linalg.norm(xyz[:, :2] - np.asarray(center)[:2], axis=1) < clearance
+    else:
+        raise Exception("Invalid shape")
+
+
+def load_las(path, extra_dim_list=None, scale_colors=True, origin=None, center=None, clearance=None,
+             shape='square', dtype=np.float64, chunk_size=2_000_000):
+    """Load las/laz from given path as n x 6 (xyz rgb) array, or n x (6 + len(extra_dim_list)) with the given extra
+    dimensions appended, optionally cropped with extract_area while streaming, laz files require laszip on path"""
+    chunks = [np.concatenate(x, axis=-1) for x in iter_las_chunks(path, chunk_size=chunk_size, scale_colors=scale_colors, origin=origin,
+                                                                   center=center, clearance=clearance, shape=shape, dtype=dtype, extra_dims=extra_dim_list)]
+    if len(chunks) == 0:
+        return np.zeros((0, 6 + (0 if extra_dim_list is None else len(extra_dim_list))), dtype=dtype)
+    return np.concatenate(chunks)
 
 
 def bits_per_dim(log_likelihood, dims_prod):
@@ -284,6 +346,34 @@ def co_unit_sphere(points_0, points_1, return_inverse=False):
         return joint[:l_0, :], joint[l_0:]
 
 
+def batched_co_unit_sphere(points_0, points_1):
+    """Joint zero mean unit ball normalization of batches (b,n_0,d) and (b,n_1,d), as co_unit_sphere per item"""
+    l_0 = points_0.shape[1]
+    joint = torch.cat((points_0, points_1), dim=1)
+    mean = joint[..., :3].mean(dim=1)
+    xyz = joint[..., :3] - mean.unsqueeze(1)
+    furthest_distance = torch.linalg.norm(xyz, dim=-1).max(dim=1)[0]
+    joint = torch.cat((xyz / furthest_distance[:, None, None], joint[..., 3:]), dim=-1)
+    inverse = {'furthest_distance': furthest_distance, 'mean': mean}
+    return joint[:, :l_0], joint[:, l_0:], inverse
+
+
+def batched_fps(points, lengths, n_samples):
+    """Farthest point sampling of padded batch (b,n,d) with lengths valid points each, starting at first point as
+    torch_cluster fps with random_start=False. Items with fewer than n_samples points repeat points"""
+    b, n, _ = points.shape
+    batch_range = torch.arange(b, device=points.device)
+    valid = torch.arange(n, device=points.device).unsqueeze(0) < lengths.unsqueeze(1)
+    # Padding gets a negative distance so it is never selected
+    min_dists = torch.where(valid, torch.full_like(valid, Inf, dtype=points.dtype), -torch.ones_like(valid, dtype=points.dtype))
+    indices = torch.zeros((b, n_samples), dtype=torch.long, device=points.device)
+    for i in range(1, n_samples):
+        last = points[batch_range, indices[:, i-1]].unsqueeze(1)
+        min_dists = torch.minimum(min_dists, ((points - last)**2).sum(dim=-1))
+        indices[:, i] = min_dists.argmax(dim=-1)
+    return indices
+
+
 
 def view_cloud_o3d(xyz, rgb, show=True):
     """Visualize cloud with o3d"""
@@ -322,11 +412,76 @@ def rotate_xy(rad):
         [[math.cos(rad), -math.sin(rad)], [math.sin(rad), math.cos(rad)]])
 
 
+# Pade 13 coefficients and largest 1-norm it is accurate for without scaling (Higham 2005)
+PADE_13 = [64764752532480000., 32382376266240000., 7771770303897600., 1187353796428800., 129060195264000.,
+           10559470521600., 670442572800., 33522128640., 1323241920., 40840800., 960960., 16380., 182., 1.]
+THETA_13 = 5.371920351148152
+
+
+def pade_13(x):
+    """Pade 13 approximant of exp of (b,n,n) x with 1-norm at most THETA_13"""
+    b = PADE_13
+    eye = torch.eye(x.shape[-1], dtype=x.dtype, device=x.device).expand_as(x)
+    x2 = x @ x
+    x4 = x2 @ x2
+    x6 = x4 @ x2
+    u = x @ (x6 @ (b[13]*x6 + b[11]*x4 + b[9]*x2) + b[7]*x6 + b[5]*x4 + b[3]*x2 + b[1]*eye)
+    v = x6 @ (b[12]*x6 + b[10]*x4 + b[8]*x2) + b[6]*x6 + b[4]*x4 + b[2]*x2 + b[0]*eye
+    return torch.linalg.solve(v - u, v + u)
+
+
+class MatrixExpPade(torch.autograd.Function):
+    """Batched scaling and squaring with a Pade 13 approximant. Each matrix gets its own number of squarings but all run
+    max_squarings steps (squaring masked off when done) so nothing depends on values on the host.
+    Backward reuses the squaring intermediates and gets the Pade derivative from one block matrix approximant"""
+
+    @staticmethod
+    def forward(ctx, x, max_squarings):
+        shape = x.shape
+        x = x.reshape(-1, shape[-2], shape[-1])
+        norm = x.abs().sum(dim=-2).amax(dim=-1)
+        squarings = torch.ceil(torch.log2(norm / THETA_13)).clamp(0, max_squarings)
+        scaled = x / (2**squarings)[:, None, None]
+        result = pade_13(scaled)
+        intermediates = []
+        for step in range(max_squarings):
+            intermediates.append(result)
+            result = torch.where((step < squarings)[:, None, None], result @ result, result)
+        ctx.save_for_backward(scaled, squarings, *intermediates)
+        ctx.shape = shape
+        return result.reshape(shape)
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad):
+        scaled, squarings, *intermediates = ctx.saved_tensors
+        n = scaled.shape[-1]
+        grad = grad.reshape(scaled.shape)
+        for step in reversed(range(len(intermediates))):
+            e = intermediates[step]
+            grad = torch.where((step < squarings)[:, None, None], grad @ e.transpose(1, 2) + e.transpose(1, 2) @ grad, grad)
+        # Frechet derivative L(x^T, grad) is the upper right block of exp([[x^T, grad], [0, x^T]]), grad is scaled
+        # down (the derivative is linear in it) to keep the block within the range of the approximant
+        grad_scale = 1e-3 / grad.abs().sum(dim=-2).amax(dim=-1).clamp_min(torch.finfo(grad.dtype).tiny)[:, None, None]
+        block = torch.zeros((scaled.shape[0], 2*n, 2*n), dtype=scaled.dtype, device=scaled.device)
+        block[:, :n, :n] = block[:, n:, n:] = scaled.transpose(1, 2)
+        block[:, :n, n:] = grad * grad_scale
+        grad = pade_13(block)[:, :n, n:] / grad_scale / (2**squarings)[:, None, None]
+        return grad.reshape(ctx.shape), None
+
+
+def expm_pade(x, max_squarings=8):
+    """Matrix exponential of (...,n,n) x without host synchronisation, accurate for 1-norms up to THETA_13*2**max_squarings"""
+    return MatrixExpPade.apply(x, max_squarings)
+
+
 def expm(x, eps, algo='torch'):
     if algo == 'torch':
         return torch.matrix_exp(x)
     elif algo == 'original':
         return exp_from_paper(x, eps)
+    elif algo == 'pade':
+        return expm_pade(x)
     else:
         raise Exception('Invalid expm algo!')
 
@@ -466,43 +621,127 @@ def rotate_xy(rad):
     return matrix
 
 
+def batched_rotate_xy(rads):
+    """Rotation matrices (b,2,2) of rads (b)"""
+    cos, sin = torch.cos(rads), torch.sin(rads)
+    return torch.stack((torch.stack((cos, -sin), dim=-1), torch.stack((sin, cos), dim=-1)), dim=-2)
+
+
 def is_valid(tensor):
     assert not torch.logical_or(
         tensor.isnan(), tensor.isinf()).any(), 'Invalid values!'
 
-def get_voxel_index(point,min,max,sizes):
-    axis_size = torch.ceil((max-min) / sizes)
-    n_total_per_axis = torch.Tensor([axis_size[0:index].prod() for index in range(len(axis_size))])
-    n_per_axis = ((point - min)//sizes).long()
-    index =  (n_total_per_axis*n_per_axis).sum()
-    return index
+class VoxelGrid:
+    """Regular grid of voxels of given size from start, shape cells per axis (from end if not given, end=None for an
+    unbounded grid). Cells have integer linear keys (x fastest), only occupied cells are ever materialized"""
+
+    def __init__(self, start, end, size, shape=None):
+        self.start = torch.as_tensor(start, dtype=torch.float64)
+        self.size = torch.as_tensor(size, dtype=torch.float64)
+        if shape is not None:
+            self.shape = torch.as_tensor(shape, dtype=torch.long)
+        elif end is not None:
+            self.shape = torch.ceil((torch.as_tensor(end, dtype=torch.float64) - self.start) / self.size).long().clamp_min(1)
+        else:
+            self.shape = None
 
-def get_voxel_center(point,min,sizes):
-    """Get voxel center given start of voxel,a point from the voxel and the voxel sizes"""
-    n_per_axis = torch.abs((point - min)//sizes)
-    min_side = min + (n_per_axis * sizes)
-    center  = min_side + sizes/2
-    return center
+    @property
+    def strides(self):
+        return torch.cat((torch.ones(1, dtype=torch.long), torch.cumprod(self.shape, 0)[:-1]))
 
-def get_all_voxel_centers(start,end,size):
-    """Get all voxel centers given start end (min-max) and voxel sizes"""
-    n_dims = len(size)
-    num_voxels = ((end - start) / size).long() + 1
+    def cells(self, points):
+        """Per axis cell of points, points past the last cell (or before the first) are put in it"""
+        cells = torch.floor((points.double() - self.start.to(points.device)) / self.size.to(points.device)).long().clamp_min(0)
+        if self.shape is not None:
+            cells = torch.minimum(cells, self.shape.to(points.device) - 1)
+        return cells
 
-    axis_centers = [torch.arange(start[i] + size[i] / 2, end[i] + size[i] / 2, size[i]) for i in range(n_dims)]
+    def keys(self, points):
+        """Linear key of the cell of each point"""
+        return self.cell_keys(self.cells(points))
 
-    centers = torch.stack(torch.meshgrid(*axis_centers[::-1])).reshape((n_dims,-1)).T.flip(-1)
-    return centers 
+    def cell_keys(self, cells):
+        return (cells * self.strides.to(cells.device)).sum(-1)
 
-def voxelize(pos,start,end,size):
-    """Get all voxel centers given start end (min-max) and voxel sizes"""
-    n_dims = len(size)
-    axis_centers = [torch.arange(start[i] + size[i] / 2, end[i] + size[i] / 2, size[i]) for i in range(n_dims)]
+    def key_cells(self, keys):
+        """Per axis cell of linear keys"""
+        return torch.stack([(keys // stride) % n for stride, n in zip(self.strides.tolist(), self.shape.tolist())], dim=-1)
+
+    def cell_centers(self, cells):
+        return self.start.to(cells.device) + self.size.to(cells.device) / 2 + cells * self.size.to(cells.device)
+
+    def centers(self, keys):
+        """Centers of cells with linear keys"""
+        return self.cell_centers(self.key_cells(keys))
+
+    def point_centers(self, points):
+        """Center of the cell of each point"""
+        return self.cell_centers(self.cells(points)).to(points.dtype)
+
+    def occupy(self, points):
+        """Sorted keys of occupied cells and the index into them of each point"""
+        return torch.unique(self.keys(points), sorted=True, return_inverse=True)
 
-    centers = torch.stack(torch.meshgrid(*axis_centers[::-1])).reshape((n_dims,-1)).T.flip(-1)
+    @staticmethod
+    def lookup(occupied, keys):
+        """Index of keys in sorted occupied keys, -1 if not occupied"""
+        index = torch.searchsorted(occupied, keys).clamp_max(max(len(occupied) - 1, 0))
+        found = occupied[index] == keys if len(occupied) > 0 else torch.zeros_like(keys, dtype=torch.bool)
+        return torch.where(found, index, torch.full_like(index, -1))
 
-    labels = get_knn(pos,centers,1)
-    return labels ,centers
+    def neighbours(self, keys, reach=1):
+        """Keys of the cells within reach cells (per axis, int or per axis list) of each key (k,n_offsets), -1 outside grid"""
+        reach = [reach] * len(self.shape) if isinstance(reach, int) else list(reach)
+        offsets = torch.cartesian_prod(*[torch.arange(-x, x + 1) for x in reach]).to(keys.device)
+        cells = self.key_cells(keys).unsqueeze(1) + offsets.reshape(1, -1, len(reach))
+        inside = ((cells >= 0) & (cells < self.shape.to(keys.device))).all(dim=-1)
+        return torch.where(inside, self.cell_keys(cells), torch.full_like(inside, -1, dtype=torch.long))
 
+    def all_centers(self):
+        """Centers of all cells in key order, dense in the volume of the grid"""
+        return self.centers(torch.arange(int(self.shape.prod())))
 
 
+def get_voxel_index(point,min,max,sizes):
+    return VoxelGrid(min,max,sizes).keys(point)
+
+def get_voxel_center(point,min,sizes):
+    """Get voxel center given start of voxel,a point from the voxel and the voxel sizes"""
+    return VoxelGrid(min,None,sizes).point_centers(point)
+
+def get_all_voxel_centers(start,end,size):
+    """Get all voxel centers given start end (min-max) and voxel sizes"""
+    return VoxelGrid(start,end,size).all_centers().float()
+
+def voxelize(pos,start,end,size):
+    """Assign points to voxels of given sizes from start, returns label of each point and centers of occupied voxels"""
+    grid = VoxelGrid(start,end,size)
+    occupied, labels = grid.occupy(pos[:, :3])
+    return labels, grid.centers(occupied).to(pos.dtype)
+
+
+if __name__ == '__main__':
+    # Benchmark expm algorithms (forward and backward) across batch sizes against torch.matrix_exp
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    for dim, batch_sizes in [(3, [1, 1000, 100000]), (64, [1, 100]), (300, [1])]:
+        for batch_size in batch_sizes:
+            x = (torch.randn((batch_size, dim, dim), device=device) / math.sqrt(dim)).requires_grad_()
+            reference = torch.matrix_exp(x.double())
+            grad_reference = torch.autograd.grad(reference.sum(), x)[0] if batch_size * dim < 10**5 else None
+            for algo in ['torch', 'original', 'pade']:
+                def run():
+                    out = expm(x, eps=1e-8, algo=algo)
+                    return out, torch.autograd.grad(out.sum(), x)[0]
+                run()
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+                for _ in range(5):
+                    out, grad = run()
+                if device == 'cuda':
+                    torch.cuda.synchronize()
+                elapsed = (time.time() - start) / 5
+                error = ((out.double() - reference).abs().max() / reference.abs().max()).item()
+                grad_error = ((grad.double() - grad_reference).abs().max() / grad_reference.abs().max()).item() if grad_reference is not None else float('nan')
+                print(f'dim {dim:>3} batch {batch_size:>6} {algo:>8}: {elapsed*1000:9.2f} ms, relative error {error:.2e}, grad relative error {grad_error:.2e}')